@@ -1,21 +1,55 @@
 from __future__ import division
+import os
+import json
+import logging
+import bisect
+import threading
+import subprocess
 import numpy as np
 import cv2
 from multiprocessing.pool import ThreadPool
-from collections import deque
+from collections import deque, OrderedDict
+
+log = logging.getLogger(__name__)
 
 class RateChangedVideo(object):
-	"reads the last of every n frames"
-	
-	def __init__(self, vid, decimate=1):
+	"""resamples a video to a lower frame rate, by presentation timestamps.
+
+	output frame n shows the source frame nearest to n/fps. the rate may be
+	fractional (50 -> 30, 59.94 -> 29.97). frames in between are skipped
+	with grab() only, never retrieved.
+	"""
+
+	def __init__(self, vid, decimate=1, fps=None):
 		self.vid = vid
-		self.decimate = decimate
-	
+		self.srcfps = vid.get(cv2.CAP_PROP_FPS)
+		self.fps = fps or (self.srcfps / decimate)
+		assert self.fps <= self.srcfps
+
+		# last output frame still has a source frame within half a source period
+		srcframes = int(vid.get(cv2.CAP_PROP_FRAME_COUNT))
+		self.framecount = int(np.floor((srcframes - 0.5) * self.fps / self.srcfps + 1e-9)) + 1
+		self.pos = 0 # next output frame
+
+	def _earliest(self, pos):
+		# a source frame from this time on is the nearest one to output frame pos
+		return pos / self.fps - 0.5 / self.srcfps - 1e-4
+
+	def _srctime(self):
+		# of the last grabbed source frame, in seconds from the stream's start
+		msec = self.vid.get(cv2.CAP_PROP_POS_MSEC)
+		srcpos = self.vid.get(cv2.CAP_PROP_POS_FRAMES)
+		if msec <= 0 and srcpos > 1: # backend has no timestamps
+			return (srcpos - 1) / self.srcfps
+		return msec / 1000
+
 	def grab(self):
-		for i in xrange(self.decimate):
-			rv = self.vid.grab()
-			if not rv: return False
+		earliest = self._earliest(self.pos)
+		while True:
+			if not self.vid.grab(): return False
+			if self._srctime() >= earliest: break
 
+		self.pos += 1
 		return True
 	
 	def retrieve(self):
@@ -30,15 +64,668 @@ class RateChangedVideo(object):
 		return (rv, frame)
 	
 	def seek(self, pos):
-		pos = (int(pos)+1) * self.decimate - 1
-		self.vid.set(cv2.CAP_PROP_POS_FRAMES, pos)
+		pos = int(pos)
+		# land on the first source frame grab() would take. for a GOP start
+		# (from_source_index) that's exactly its key frame, any earlier and
+		# the backend decodes the GOP before it too
+		srcpos = max(0, int(np.ceil(self._earliest(pos) * self.srcfps - 1e-6)))
+		self.vid.set(cv2.CAP_PROP_POS_MSEC, srcpos / self.srcfps * 1000)
+		self.pos = pos
 	
 	def tell(self):
-		pos = int(self.vid.get(cv2.CAP_PROP_POS_FRAMES))
-		pos //= self.decimate
-		return pos
+		return self.pos
+
+	def from_source_index(self, srcpos):
+		"first position whose frame is at or after source frame srcpos"
+		return max(0, int(np.ceil((srcpos - 0.5) * self.fps / self.srcfps - 1e-9)))
+
+
+def file_signature(fname):
+	"changes when the file is replaced or modified"
+	st = os.stat(fname)
+	return [st.st_size, int(st.st_mtime)]
+
+
+class GOPIndex(object):
+	"""seekable (key frame) positions of a video file, in source frame numbers.
+
+	built once by scanning the packet flags with ffprobe (no decoding), and
+	persisted next to the source. the saved index is invalidated when the
+	source's size or mtime change. packets come in decode order, they're
+	numbered by their pts, so B-frames and open GOPs get display numbers.
+	"""
+
+	def __init__(self, keyframes):
+		self.keyframes = sorted(keyframes)
+
+	@classmethod
+	def scan(cls, fname):
+		output = subprocess.check_output([
+			'ffprobe',
+			'-v', 'error',
+			'-select_streams', 'v:0',
+			'-show_entries', 'packet=pts,flags',
+			'-of', 'csv=p=0',
+			fname
+		])
+		# one line per packet in decode order, 'pts,flags'. 'K' marks key
+		# frames. without pts (raw streams), decode order is display order
+		packets = [line.split(',')[:2] for line in output.split()]
+		order = range(len(packets))
+		if all(pts.lstrip('-').isdigit() for (pts, flags) in packets):
+			order.sort(key=lambda i: int(packets[i][0]))
+		return cls([n for (n, i) in enumerate(order) if 'K' in packets[i][1]])
+
+	@classmethod
+	def load(cls, indexfile, fname):
+		if not os.path.exists(indexfile):
+			return None
+		data = json.load(open(indexfile))
+		if data.get('source_signature') != file_signature(fname):
+			return None
+		return cls(data['keyframes'])
+
+	def save(self, indexfile, fname):
+		json.dump({
+			'source_signature': file_signature(fname),
+			'keyframes': self.keyframes,
+		}, open(indexfile, 'w'))
+
+	@classmethod
+	def open(cls, fname, indexfile=None):
+		"loads the persisted index, or scans and saves it. None if ffprobe fails."
+		if indexfile is None:
+			indexfile = fname + '.gops.json'
+		index = cls.load(indexfile, fname)
+		if index is None:
+			try:
+				index = cls.scan(fname)
+			except (OSError, subprocess.CalledProcessError) as e:
+				log.warning("GOP index: can't scan %s: %s", fname, e)
+				return None
+			try:
+				index.save(indexfile, fname)
+			except (IOError, OSError) as e: # read-only source directory
+				log.warning("GOP index: can't save %s: %s", indexfile, e)
+		return index
+
+	def __len__(self):
+		return len(self.keyframes)
+
+	def start(self, srcpos):
+		"key frame at or before srcpos"
+		i = bisect.bisect_right(self.keyframes, srcpos) - 1
+		return self.keyframes[i] if (i >= 0) else 0
+
+
+class FrameCache(object):
+	"""LRU frame cache with a byte budget.
+
+	frames are kept in an OrderedDict (oldest -> newest), so touching,
+	inserting and evicting are O(1). pinned frames live in a separate dict
+	and are never evicted; they still count towards the budget. a frame just
+	put is kept even when pinned frames take up the whole budget.
+
+	planes derived from a frame (gray, scaled, ...) are kept alongside it,
+	count towards the budget and are evicted together with the frame.
+	"""
+
+	def __init__(self, maxbytes):
+		self.maxbytes = maxbytes
+		self.nbytes = 0
+		self.lru = OrderedDict() # index -> frame, oldest -> newest
+		self.pinned = {} # index -> frame
+		self.planes = {} # index -> {name: plane}
+		self.pinset = set() # indices to keep, cached or not
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def __len__(self):
+		return len(self.lru) + len(self.pinned)
+
+	def __contains__(self, index):
+		return (index in self.lru) or (index in self.pinned)
+
+	def __iter__(self):
+		for index in self.pinned:
+			yield index
+		for index in self.lru:
+			yield index
+
+	def __getitem__(self, index):
+		# peek, doesn't count as use
+		if index in self.pinned:
+			return self.pinned[index]
+		return self.lru[index]
+
+	def get(self, index):
+		if index in self.pinned:
+			self.hits += 1
+			return self.pinned[index]
+
+		frame = self.lru.pop(index, None)
+		if frame is None:
+			self.misses += 1
+			return None
+
+		self.hits += 1
+		self.lru[index] = frame # now newest
+		return frame
+
+	def touch(self, index):
+		frame = self.lru.pop(index, None)
+		if frame is not None:
+			self.lru[index] = frame
+
+	def put(self, index, frame):
+		self.discard(index)
+		self.nbytes += frame.nbytes
+		if index in self.pinset:
+			self.pinned[index] = frame
+		else:
+			self.lru[index] = frame
+		self._evict(keep=index)
+
+	def discard(self, index):
+		frame = self.pinned.pop(index, None)
+		if frame is None:
+			frame = self.lru.pop(index, None)
+		if frame is not None:
+			self.nbytes -= frame.nbytes
+			self._drop_planes(index)
+
+	def plane(self, index, name):
+		return self.planes.get(index, {}).get(name)
+
+	def add_plane(self, index, name, plane):
+		if index not in self: return
+		planes = self.planes.setdefault(index, {})
+		if name in planes:
+			self.nbytes -= planes[name].nbytes
+		planes[name] = plane
+		self.nbytes += plane.nbytes
+		self._evict()
+
+	def _drop_planes(self, index):
+		for plane in self.planes.pop(index, {}).itervalues():
+			self.nbytes -= plane.nbytes
+
+	def pin(self, indices):
+		"replaces the set of pinned indices"
+		indices = set(indices)
+
+		for index in self.pinset - indices:
+			frame = self.pinned.pop(index, None)
+			if frame is not None:
+				self.lru[index] = frame # newest, evicted last
+
+		for index in indices - self.pinset:
+			frame = self.lru.pop(index, None)
+			if frame is not None:
+				self.pinned[index] = frame
+
+		self.pinset = indices
+		self._evict()
+
+	def _evict(self, keep=None):
+		while self.nbytes > self.maxbytes and self.lru:
+			if len(self.lru) == 1 and keep in self.lru: break
+			(index, frame) = self.lru.popitem(last=False)
+			self.nbytes -= frame.nbytes
+			self._drop_planes(index)
+			self.evictions += 1
+
+	def stats(self):
+		return {
+			'frames': len(self),
+			'pinned': len(self.pinned),
+			'mbytes': self.nbytes / 2**20,
+			'hits': self.hits,
+			'misses': self.misses,
+			'evictions': self.evictions,
+		}
+
+
+class FrameStore(object):
+	"""decoded frames on disk, in a fixed-stride raw file read through np.memmap.
+
+	frames can be stored downscaled (scale < 1), they're scaled back up on
+	get(). 'key' identifies the content (source signature, rate, ...); the
+	store is recreated when it changes. at most maxbytes are used on disk,
+	frames beyond that capacity are not stored.
+
+	a frame is marked valid on disk only after its bytes were flushed, every
+	'syncevery' frames and on close(). after a crash the frames put since
+	the last flush are simply decoded again.
+
+	readonly: an existing store is read, never written or created (renders)
+	"""
+
+	def __init__(self, basename, key, count, (width, height), scale=1.0, maxbytes=None, syncevery=100, readonly=False):
+		self.width = width
+		self.height = height
+		self.scale = scale
+		self.storesize = (int(round(width * scale)), int(round(height * scale)))
+		(sw, sh) = self.storesize
+		framebytes = sw * sh * 3
+
+		capacity = count
+		if maxbytes is not None:
+			capacity = min(count, maxbytes // framebytes)
+		self.capacity = capacity
+
+		prefix = "{0}.{1}x{2}".format(basename, sw, sh)
+		self.headerfile = prefix + '.json'
+		framesfile = prefix + '.raw'
+		validfile = prefix + '.valid'
+
+		header = {
+			'key': key,
+			'size': [sw, sh],
+			'capacity': capacity,
+		}
+
+		reusable = (
+			os.path.exists(self.headerfile) and
+			os.path.exists(framesfile) and os.path.getsize(framesfile) == capacity * framebytes and
+			os.path.exists(validfile) and os.path.getsize(validfile) == capacity and
+			json.load(open(self.headerfile)) == json.loads(json.dumps(header)))
+
+		mode = 'r' if readonly else 'r+'
+		if readonly and not reusable:
+			capacity = self.capacity = 0
+		elif not reusable:
+			log.info("frame store: creating %s (%d frames, %.0f MB)", framesfile, capacity, capacity * framebytes / 2**20)
+			mode = 'w+'
+			if os.path.exists(self.headerfile):
+				os.unlink(self.headerfile)
+
+		self.readonly = readonly
+		self.syncevery = syncevery
+		self.unsynced = set() # stored, not yet marked valid on disk
+		self.frames = None
+		self.valid = None
+		if capacity > 0:
+			self.frames = np.memmap(framesfile, dtype=np.uint8, mode=mode, shape=(capacity, sh, sw, 3))
+			self.valid = np.memmap(validfile, dtype=np.uint8, mode=mode, shape=(capacity,))
+
+		if mode == 'w+':
+			json.dump(header, open(self.headerfile, 'w'))
+
+	def __contains__(self, index):
+		return (0 <= index < self.capacity) and (bool(self.valid[index]) or index in self.unsynced)
+
+	def get(self, index):
+		frame = np.array(self.frames[index]) # page cache -> heap
+		if self.scale != 1:
+			frame = cv2.resize(frame, (self.width, self.height), interpolation=cv2.INTER_LINEAR)
+		return frame
+
+	def put(self, index, frame):
+		if self.readonly or not (0 <= index < self.capacity): return
+		if self.scale != 1:
+			frame = cv2.resize(frame, self.storesize, interpolation=cv2.INTER_AREA)
+		self.frames[index] = frame
+		self.unsynced.add(index)
+		if len(self.unsynced) >= self.syncevery:
+			self.sync()
+
+	def sync(self):
+		"flushes the stored frames, then marks them valid"
+		if self.readonly or (self.frames is None): return
+		self.frames.flush()
+		for index in self.unsynced:
+			self.valid[index] = 1
+		self.valid.flush()
+		self.unsynced.clear()
+
+	def close(self):
+		self.sync()
+
+
+class StripeStore(object):
+	"""a few rows per frame, around a given y, for the x-t graph.
+
+	rows are scaled to a fixed width and kept in their own byte-budgeted
+	cache, so the graph can cover far more frames than the frame cache.
+	"""
+
+	def __init__(self, count, width, radius=2, maxbytes=256 * 2**20):
+		self.width = width
+		self.radius = radius
+		self.rows = FrameCache(maxbytes) # index -> (2*radius+1, width, 3)
+		self.tops = np.full(count, -1, dtype=np.int32) # first row's y
+		self.lock = threading.Lock()
+
+	def __contains__(self, index):
+		with self.lock:
+			return index in self.rows
+
+	def put(self, index, frame, y):
+		n = 2*self.radius + 1
+		y0 = int(np.clip(int(round(y)) - self.radius, 0, frame.shape[0] - n))
+		rows = cv2.resize(frame[y0:y0+n], (self.width, n), interpolation=cv2.INTER_AREA)
+		with self.lock:
+			self.rows.put(index, rows)
+			self.tops[index] = y0
+
+	def get(self, index, y):
+		"row at y, or None if that isn't stored"
+		with self.lock:
+			if index not in self.rows: return None
+			dy = int(round(y)) - self.tops[index]
+			if not (0 <= dy <= 2*self.radius): return None
+			return self.rows.get(index)[dy]
 
 
 class CachingVideoReader(object):
-	def __init__(self):
-		pass
+	"""thread-safe random access to the frames of a sequential video source.
+
+	vid is anything with grab/retrieve/seek/tell (RateChangedVideo, ...).
+	frames are kept in a cache, a FrameCache by default; pass any object with
+	the same interface as 'cache' for a different eviction policy. a FrameStore
+	is consulted before decoding, and filled with what's decoded.
+
+	a background thread keeps 'readahead' frames decoded ahead of the last
+	get(), in the direction given to set_direction(), and serves prefetch().
+	going backwards, whole GOPs (or numstep chunks) are decoded at once.
+
+	preprocess: functions frame -> frame, applied to frames entering the cache
+	hooks: functions (index, frame), called for frames entering the cache
+	"""
+
+	def __init__(self, vid, framecount, cachebytes=2**30, cache=None, numstep=25,
+			readahead=0, gops=None, store=None, preprocess=(), hooks=()):
+		self.vid = vid
+		self.framecount = framecount
+		self.cache = cache if (cache is not None) else FrameCache(cachebytes)
+		self.numstep = numstep
+		self.gops = gops # sorted key frame indices, if known
+		self.store = store # FrameStore, optional
+		self.preprocess = list(preprocess)
+		self.hooks = list(hooks)
+		self.index = -1 # last get(), read-ahead is relative to it
+
+		self.decoded = 0
+		self.restored = 0 # from the store
+		self.seeks = 0
+
+		# lock order: vidlock, then lock
+		self.vidlock = threading.RLock() # decoder state (position)
+		self.lock = threading.RLock() # cache, index, direction, requests
+		self.wakeup = threading.Condition(self.lock)
+
+		self.readahead = readahead
+		self.direction = 0 # +1, -1, 0 = paused
+		self.refilling = False
+		self.failed = None # frame read-ahead couldn't decode, skipped until the playhead moves back
+		self.requests = deque() # (start, stop) from prefetch()
+		self.running = True
+		self.thread = threading.Thread(target=self._background_loop, name="readahead")
+		self.thread.daemon = True
+		self.thread.start()
+
+	def __len__(self):
+		return self.framecount
+
+	def close(self):
+		if self.thread is not None:
+			with self.lock:
+				self.running = False
+				self.wakeup.notify()
+			self.thread.join()
+			self.thread = None
+
+		if self.store is not None:
+			self.store.close()
+
+	def stats(self):
+		with self.lock:
+			stats = self.cache.stats()
+		stats.update(decoded=self.decoded, restored=self.restored, seeks=self.seeks)
+		return stats
+
+	### access
+
+	def get(self, index):
+		"frame at index, decoding if needed. None past the end."
+		if not (0 <= index < self.framecount):
+			return None
+
+		with self.lock:
+			frame = self.cache.get(index) # counts the hit or miss
+			# going backwards, make sure the frame before is there too
+			ready = (frame is not None) and (index >= self.index or index-1 in self.cache)
+
+		if not ready:
+			with self.vidlock:
+				if (index < self.index) and not all(self._cached(i) for i in xrange(index-1, index+1)):
+					log.debug("prefetching back from %d", index)
+					self._fill(self._chunk_start(index), index)
+
+				if not self._cached(index):
+					self._fill(index, index)
+
+		with self.lock:
+			if self.failed is not None:
+				ahead = self.failed - self.index # the side read-ahead failed on
+				if (ahead > 0 and not (self.index <= index < self.failed)) or (ahead < 0 and not (self.failed < index <= self.index)):
+					self.failed = None
+			self.index = index
+			if frame is None and index in self.cache:
+				frame = self.cache[index]
+			self.wakeup.notify() # playhead moved
+
+		return frame
+
+	def get_range(self, start, stop):
+		"frames [start, stop], decoding what's missing in one pass"
+		start = max(start, 0)
+		stop = min(stop, self.framecount-1)
+		frames = []
+		with self.vidlock:
+			# each frame taken as it's there, a range over the cache budget
+			# would evict its own start
+			for i in xrange(start, stop+1):
+				if not self._fill(i, i): break
+				frames.append(self.peek(i))
+		return frames + [None] * (stop+1 - start - len(frames))
+
+	def prefetch(self, start, stop):
+		"decodes [start, stop] in the background"
+		start = max(start, 0)
+		stop = min(stop, self.framecount-1)
+		if start > stop: return
+		with self.lock:
+			self.requests.append((start, stop))
+			self.wakeup.notify()
+
+	def peek(self, index):
+		"cached frame or None, never decodes"
+		with self.lock:
+			if index in self.cache:
+				return self.cache[index]
+			return None
+
+	def plane(self, index, name, compute):
+		"compute(frame) for a cached frame, done at most once while it's cached"
+		with self.lock:
+			if index not in self.cache:
+				return None
+			plane = self.cache.plane(index, name)
+			if plane is not None:
+				return plane
+			frame = self.cache[index]
+
+		plane = compute(frame)
+		with self.lock:
+			self.cache.add_plane(index, name, plane) # dropped if evicted meanwhile
+		return plane
+
+	def pin(self, indices):
+		with self.lock:
+			self.cache.pin(indices)
+
+	def set_direction(self, direction):
+		"+1 or -1 to read ahead in that direction, 0 to pause"
+		with self.lock:
+			if direction != self.direction:
+				self.direction = direction
+				self.refilling = False
+				self.wakeup.notify()
+
+	### decoding
+
+	def _cached(self, index):
+		with self.lock:
+			return index in self.cache
+
+	def _chunk_start(self, index):
+		# where to start decoding forward to reach index: its GOP, or numstep back
+		if self.gops:
+			i = bisect.bisect_right(self.gops, index) - 1
+			return self.gops[i] if (i >= 0) else 0
+		return max(0, index - self.numstep)
+
+	def _seek(self, index):
+		# called with self.vidlock held. the next grab() yields frame index.
+		vidpos = self.vid.tell()
+		if vidpos == index: return
+
+		# with a GOP index, seek to the key frame and decode forward,
+		# otherwise CAP_PROP_POS_FRAMES may land on the wrong frame
+		if self.gops:
+			start = self._chunk_start(index)
+			near = (start <= vidpos <= index)
+		else:
+			start = index
+			near = (0 <= index - vidpos <= self.numstep)
+
+		if not near:
+			log.debug("seeking to %d", start)
+			self.vid.seek(start)
+			self.seeks += 1
+			vidpos = start
+
+		while vidpos < index:
+			if not self.vid.grab(): return
+			vidpos += 1
+
+	def _add(self, index, frame):
+		for fn in self.preprocess:
+			frame = fn(frame)
+		with self.lock:
+			self.cache.put(index, frame)
+		for hook in self.hooks:
+			hook(index, frame)
+
+	def _fill(self, start, stop):
+		# called with self.vidlock held. caches [start, stop], from the
+		# frame store where possible, decoding forward otherwise.
+		for i in xrange(start, stop+1):
+			if self._cached(i):
+				with self.lock:
+					self.cache.touch(i)
+
+			elif (self.store is not None) and (i in self.store):
+				self._add(i, self.store.get(i))
+				self.restored += 1
+
+			else:
+				self._seek(i)
+				if not self.vid.grab(): return False
+				(rv, frame) = self.vid.retrieve()
+				if not rv: return False
+				self.decoded += 1
+				if self.store is not None:
+					self.store.put(i, frame)
+				self._add(i, frame)
+
+		return True
+
+	### background thread
+
+	def _next_wanted(self):
+		# called with self.lock held. next index to decode, or None
+		while self.requests:
+			(start, stop) = self.requests[0]
+			for i in xrange(start, stop+1):
+				if i not in self.cache:
+					self.requests[0] = (i, stop)
+					return i
+			self.requests.popleft()
+
+		if self.direction > 0:
+			stop = min(self.index + 1 + self.readahead, self.framecount)
+			if self.failed is not None and self.failed > self.index:
+				stop = min(stop, self.failed)
+			for i in xrange(self.index+1, stop):
+				if i not in self.cache:
+					return i
+
+		elif self.direction < 0:
+			floor = 0
+			if self.failed is not None and self.failed < self.index:
+				floor = self.failed+1
+			start = max(floor, self.index - self.readahead)
+			missing = [i for i in xrange(start, self.index) if i not in self.cache]
+			if not missing:
+				self.refilling = False
+				return None
+
+			if not self.refilling and (self.index-1 - missing[-1]) >= self.readahead // 2:
+				return None
+
+			# refill a whole chunk (GOP), decoding forward from its start
+			self.refilling = True
+			for i in xrange(max(self._chunk_start(missing[-1]), floor), missing[-1]+1):
+				if i not in self.cache:
+					return i
+
+		return None
+
+	def _background_loop(self):
+		while True:
+			with self.lock:
+				index = self._next_wanted()
+				while index is None:
+					if not self.running: return
+					self.wakeup.wait()
+					index = self._next_wanted()
+
+			with self.vidlock:
+				if self._fill(index, index): continue
+
+			log.warning("readahead: no frame %d, skipping it", index)
+			with self.lock:
+				self.failed = index
+				self.requests.clear()
+
+
+if __name__ == '__main__':
+	# benchmark: python cachingvideoreader.py <video> [fps]
+	import sys, time
+	logging.basicConfig(level=logging.INFO)
+
+	vid = RateChangedVideo(cv2.VideoCapture(sys.argv[1]), fps=(float(sys.argv[2]) if len(sys.argv) > 2 else None))
+	count = min(vid.framecount, 500)
+	(h, w) = vid.read()[1].shape[:2]
+
+	for readahead in (0, 25):
+		reader = CachingVideoReader(vid, vid.framecount, cachebytes=100 * w*h*3, readahead=readahead)
+
+		for (name, indices, direction) in [
+			('forward', range(count), +1),
+			('reverse', range(count-1, -1, -1), -1),
+			('random', list(np.random.RandomState(0).randint(0, vid.framecount, 50)), 0),
+		]:
+			reader.set_direction(direction)
+			t0 = time.time()
+			for i in indices:
+				reader.get(i)
+			dt = time.time() - t0
+			print "readahead {0:2d}, {1:8s}: {2:7.1f} fps".format(readahead, name, len(indices) / dt)
+
+		print reader.stats()
+		reader.close()
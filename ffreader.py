@@ -0,0 +1,230 @@
+from __future__ import division
+import sys
+import json
+import subprocess
+import numpy as np
+import cv2
+
+class FFReader(object):
+	"""decodes a video through an ffmpeg pipe, the reading side of FFWriter.
+
+	ffmpeg decodes with its own threads and can scale, change the rate
+	(-vf fps) and convert the pixel format (bgr24, gray) on the way. frames
+	are read into numpy arrays with readinto, without an
+	intermediate string.
+
+	behaves like a cv2.VideoCapture (grab/retrieve/read, get/set of the
+	position, size, rate and count properties), so RateChangedVideo can
+	wrap it, and has the seek/tell of RateChangedVideo. seeking restarts
+	ffmpeg at the new position (-ss before -i, which is frame accurate),
+	short forward seeks (up to 'skip' frames, default a second) read on.
+
+	frames are read into a pool of up to 'buffers' preallocated arrays. a
+	buffer is reused once nothing outside the pool references it any more
+	(the caller dropped the frame, a cache evicted it).
+	"""
+
+	def __init__(self, fname, fps=None, scale=1.0, size=None, pixfmt='bgr24', threads=0, loglevel='error', buffers=8, skip=None):
+		self.fname = fname
+		self.pixfmt = pixfmt
+		self.threads = threads
+		self.loglevel = loglevel
+		self.proc = None # before probe(), __del__ may run on a failed one
+
+		self.probe()
+		self.fps = fps or self.srcfps
+		assert self.fps <= self.srcfps
+		if fps:
+			# as RateChangedVideo, the last frame has a source frame within half a source period
+			self.framecount = int(np.floor((self.srcframes - 0.5) * self.fps / self.srcfps + 1e-9)) + 1
+		else:
+			self.framecount = self.srcframes
+
+		if size is None:
+			size = (int(round(self.srcw * scale)), int(round(self.srch * scale)))
+		(self.width, self.height) = size
+
+		channels = { 'gray': 1, 'bgr24': 3, 'rgb24': 3, 'bgra': 4 }[pixfmt]
+		self.shape = (self.height, self.width) if (channels == 1) else (self.height, self.width, channels)
+		self.skip = int(round(self.fps)) if (skip is None) else skip
+
+		self.maxbuffers = buffers
+		self.pool = [np.empty(self.shape, dtype=np.uint8) for i in xrange(min(2, buffers))]
+
+		self.procpos = None # position of the next frame from the pipe
+		self.pos = 0 # next frame grab() returns
+		self.frame = None # last grabbed, a pool buffer
+
+	def probe(self):
+		output = subprocess.check_output([
+			'ffprobe',
+			'-v', 'error',
+			'-select_streams', 'v:0',
+			'-show_entries', 'stream=width,height,avg_frame_rate,r_frame_rate,nb_frames,duration:format=duration',
+			'-of', 'json',
+			self.fname
+		])
+		info = json.loads(output)
+		stream = info['streams'][0]
+		self.srcw = int(stream['width'])
+		self.srch = int(stream['height'])
+
+		(num, den) = stream.get('avg_frame_rate', '0/0').split('/')
+		if int(den) == 0 or int(num) == 0:
+			(num, den) = stream['r_frame_rate'].split('/')
+		self.srcfps = int(num) / int(den)
+
+		if stream.get('nb_frames', 'N/A') != 'N/A':
+			self.srcframes = int(stream['nb_frames'])
+		else: # containers without a frame count (m2ts)
+			duration = stream.get('duration', info.get('format', {}).get('duration'))
+			self.srcframes = int(round(float(duration) * self.srcfps))
+
+	def _start(self, pos):
+		self._stop()
+
+		filters = []
+		if self.fps != self.srcfps:
+			filters.append('fps={0!r}'.format(self.fps))
+		if (self.width, self.height) != (self.srcw, self.srch):
+			filters.append('scale={0}:{1}:flags=area'.format(self.width, self.height))
+
+		# half a source period early, the first frame out is frame pos
+		t = max(0, pos / self.fps - 0.5 / self.srcfps)
+
+		self.proc = subprocess.Popen([
+			'ffmpeg',
+			'-nostdin',
+			'-loglevel', self.loglevel,
+			'-threads', str(self.threads),
+		] + (['-ss', '{0:.6f}'.format(t)] if (pos > 0) else []) + [
+			'-i', self.fname,
+			'-an', '-sn',
+		] + (['-vf', ','.join(filters)] if filters else []) + [
+			'-pix_fmt', self.pixfmt,
+			'-f', 'rawvideo',
+			'pipe:1'
+		], stdout=subprocess.PIPE, bufsize=-1)
+		self.procpos = pos
+
+	def _stop(self):
+		if self.proc is None: return
+		self.proc.stdout.close()
+		if self.proc.poll() is None:
+			self.proc.terminate()
+		self.proc.wait()
+		self.proc = None
+		self.procpos = None
+
+	def _buffer(self):
+		# a pool buffer only the pool refers to: the list, the loop
+		# variable and getrefcount's argument
+		self.frame = None
+		for buf in self.pool:
+			if sys.getrefcount(buf) <= 3:
+				return buf
+		buf = np.empty(self.shape, dtype=np.uint8)
+		if len(self.pool) < self.maxbuffers:
+			self.pool.append(buf)
+		return buf
+
+	def _readframe(self):
+		buf = self._buffer()
+		view = memoryview(buf.reshape(-1))
+		done = 0
+		while done < len(view):
+			n = self.proc.stdout.readinto(view[done:])
+			if not n: break
+			done += n
+		del view
+		self.frame = buf
+		return done == buf.nbytes
+
+	def isOpened(self):
+		return True
+
+	def grab(self):
+		if self.pos >= self.framecount:
+			return False
+		if (self.proc is not None) and (0 < self.pos - self.procpos <= self.skip):
+			# cheaper than restarting ffmpeg: read on
+			while self.procpos < self.pos:
+				if not self._readframe():
+					self._stop()
+					return False
+				self.procpos += 1
+		if self.procpos != self.pos:
+			self._start(self.pos)
+
+		if not self._readframe():
+			self._stop()
+			return False
+
+		self.procpos += 1
+		self.pos += 1
+		return True
+
+	def retrieve(self):
+		if self.frame is None:
+			return (False, None)
+		return (True, self.frame)
+
+	def read(self):
+		if not self.grab(): return (False, None)
+		return self.retrieve()
+
+	def seek(self, pos):
+		# ffmpeg restarts on the next grab, unless it's already there
+		self.pos = int(pos)
+
+	def tell(self):
+		return self.pos
+
+	def from_source_index(self, srcpos):
+		"first position whose frame is at or after source frame srcpos"
+		return max(0, int(np.ceil((srcpos - 0.5) * self.fps / self.srcfps - 1e-9)))
+
+	def get(self, prop):
+		if prop == cv2.CAP_PROP_FPS: return self.fps
+		if prop == cv2.CAP_PROP_FRAME_COUNT: return self.framecount
+		if prop == cv2.CAP_PROP_FRAME_WIDTH: return self.width
+		if prop == cv2.CAP_PROP_FRAME_HEIGHT: return self.height
+		if prop == cv2.CAP_PROP_POS_FRAMES: return self.pos
+		# of the last grabbed frame
+		if prop == cv2.CAP_PROP_POS_MSEC: return max(0, self.pos - 1) / self.fps * 1000
+		return 0
+
+	def set(self, prop, value):
+		if prop == cv2.CAP_PROP_POS_FRAMES:
+			self.seek(value)
+		elif prop == cv2.CAP_PROP_POS_MSEC:
+			self.seek(max(0, int(np.floor(value / 1000 * self.fps + 1e-6))))
+		else:
+			return False
+		return True
+
+	def release(self):
+		self._stop()
+
+	def close(self):
+		self._stop()
+
+	def __del__(self):
+		self._stop()
+
+
+if __name__ == '__main__':
+	import time
+
+	reader = FFReader(sys.argv[1], threads=0)
+	print "{0}x{1}, {2} fps, {3} frames".format(reader.width, reader.height, reader.fps, reader.framecount)
+
+	t0 = time.time()
+	count = 0
+	while True:
+		(rv, frame) = reader.read()
+		if not rv: break
+		count += 1
+	dt = time.time() - t0
+	print "{0} frames in {1:.2f} s, {2:.1f} fps".format(count, dt, count / dt)
+	reader.release()
@@ -1,6 +1,12 @@
+import os
+import sys
+import time
+import threading
+import Queue
 import numpy as np
 import cv2
 import subprocess
+from collections import deque
 
 class NullFile(object):
 	def fileno(self):
@@ -9,16 +15,38 @@ class NullFile(object):
 	def write(self, data):
 		pass
 
+# 4:2:0 input: a (height * 3/2, width) uint8 frame, the Y plane on top of
+# the chroma (cv2.COLOR_BGR2YUV_I420 produces yuv420p)
+planar_formats = ('yuv420p', 'nv12')
+
+F_SETPIPE_SZ = 1031 # linux fcntl
+
 class FFWriter(object):
-	def __init__(self, fname, fps, (width, height), codec='libx264', pixfmt=None, moreflags=''):
+	"""raw frames into an ffmpeg process.
+
+	with queuesize > 0, frames are handed to a writer thread through a
+	bounded queue; write() only blocks while the queue is full. frames are
+	passed by reference, don't modify them after write(). pipesize sets the
+	OS pipe buffer (linux), bufsize is the Popen buffer.
+
+	ffmpeg's stderr is passed through, its tail is kept for the error
+	raised when ffmpeg exits early or fails.
+	"""
+
+	def __init__(self, fname, fps, (width, height), codec='libx264', pixfmt=None, moreflags='',
+			queuesize=0, bufsize=0, pipesize=None):
+		self.fname = fname
 		self.width = width
 		self.height = height
+		self.pixfmt = pixfmt or 'bgr24'
+		if self.pixfmt in planar_formats:
+			assert width % 2 == 0 and height % 2 == 0, "4:2:0 needs even dimensions"
 
 		self.proc = subprocess.Popen([
 			"ffmpeg",
 			'-loglevel', 'warning',
 			'-f', 'rawvideo',
-			'-pix_fmt', pixfmt or 'bgr24',
+			'-pix_fmt', self.pixfmt,
 			'-s', '{0}x{1}'.format(width, height),
 			'-r', '{0}'.format(fps),
 			'-i', 'pipe:0',
@@ -26,27 +54,166 @@ class FFWriter(object):
 		] + (moreflags.split() if isinstance(moreflags, str) else moreflags) + [
 			'-y',
 			fname
-		], stdin=subprocess.PIPE) #, stderr=NullFile())
+		], stdin=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=bufsize,
+			# own process group: ctrl-c reaches only the caller, which
+			# then closes stdin so ffmpeg can finish the file
+			preexec_fn=os.setpgrp if os.name == 'posix' else None,
+			creationflags=getattr(subprocess, 'CREATE_NEW_PROCESS_GROUP', 0))
+
+		if pipesize:
+			try:
+				import fcntl
+				fcntl.fcntl(self.proc.stdin.fileno(), F_SETPIPE_SZ, pipesize)
+			except (ImportError, IOError):
+				pass
+
+		self.closed = False
+		self.error = None
+		self.frames = 0
+		self.bytes = 0
+		self.stall = 0.0 # seconds write() waited for the queue
+		self.writetime = 0.0 # seconds spent writing to the pipe
+		self.maxdepth = 0
+
+		# keep draining stderr, a full stderr pipe would block ffmpeg
+		self.stderrtail = deque(maxlen=64)
+		self.stderrthread = threading.Thread(target=self._drain_stderr, name="ffmpeg stderr")
+		self.stderrthread.daemon = True
+		self.stderrthread.start()
+
+		self.queue = None
+		if queuesize > 0:
+			self.queue = Queue.Queue(maxsize=queuesize)
+			self.writer = threading.Thread(target=self._writer_loop, name="ffmpeg writer")
+			self.writer.daemon = True
+			self.writer.start()
 
 	def isOpened(self):
-		return True
+		return not self.closed
 
 	def write(self, frame):
 		assert frame.dtype == np.uint8
-		assert frame.shape[2] in (3, 4)
-		assert frame.shape[0] == self.height
-		assert frame.shape[1] == self.width
-		frame.tofile(self.proc.stdin)
-	
+		if self.pixfmt in planar_formats:
+			assert frame.shape == (self.height * 3 // 2, self.width)
+		else:
+			assert frame.shape[2] in (3, 4)
+			assert frame.shape[0] == self.height
+			assert frame.shape[1] == self.width
+		assert not self.closed
+
+		self._check()
+
+		if self.queue is None:
+			self._write(frame)
+			return
+
+		try:
+			self.queue.put_nowait(frame)
+		except Queue.Full:
+			t0 = time.time()
+			# wakes up to notice a writer that died
+			while True:
+				self._check()
+				try:
+					self.queue.put(frame, timeout=0.1)
+					break
+				except Queue.Full:
+					pass
+			self.stall += time.time() - t0
+		self.maxdepth = max(self.maxdepth, self.queue.qsize())
+
+	def _write(self, frame):
+		t0 = time.time()
+		try:
+			# the array's own buffer, no tostring() copy
+			self.proc.stdin.write(memoryview(np.ascontiguousarray(frame)))
+		except IOError as e:
+			self.error = self._exit_error(e)
+			raise self.error
+		self.writetime += time.time() - t0
+		self.frames += 1
+		self.bytes += frame.nbytes
+
+	def _writer_loop(self):
+		while True:
+			frame = self.queue.get()
+			if frame is None: break
+			if self.error is not None: continue # discard, write() raises
+			try:
+				self._write(frame)
+			except IOError:
+				pass
+
+	def _drain_stderr(self):
+		fd = self.proc.stderr.fileno()
+		while True:
+			data = os.read(fd, 4096)
+			if not data: break
+			sys.stderr.write(data)
+			self.stderrtail.append(data)
+
+	def _check(self):
+		if self.error is not None:
+			raise self.error
+		if self.proc.poll() is not None:
+			self.error = self._exit_error()
+			raise self.error
+
+	def _exit_error(self, cause=None):
+		# a broken pipe comes before the exit code, give it a moment
+		for attempt in xrange(20):
+			if self.proc.poll() is not None: break
+			time.sleep(0.05)
+		self.stderrthread.join(1.0)
+		tail = "".join(self.stderrtail).strip().splitlines()[-5:]
+		return IOError("ffmpeg writing {0} exited (code {1}){2}{3}".format(
+			self.fname,
+			self.proc.returncode,
+			": {0}".format(cause) if cause else "",
+			"".join("\n  " + line for line in tail)))
+
+	def stats(self):
+		return {
+			'frames': self.frames,
+			'bytes': self.bytes,
+			'queue_depth': self.queue.qsize() if self.queue else 0,
+			'queue_max': self.maxdepth,
+			'stall': self.stall,
+			'write': self.writetime,
+		}
+
 	def close(self):
-		self.proc.stdin.close()
-		return self.proc.wait()
+		"flushes the queue, waits for ffmpeg. raises if ffmpeg failed."
+		if self.closed:
+			return self.proc.returncode
+		self.closed = True
+
+		if self.queue is not None:
+			self.queue.put(None)
+			self.writer.join()
+
+		try:
+			self.proc.stdin.close()
+		except IOError:
+			pass
+		rv = self.proc.wait()
+		self.stderrthread.join()
+
+		if self.error is None and rv != 0:
+			self.error = self._exit_error()
+		if self.error is not None:
+			raise self.error
+		return rv
 
 	def release(self):
 		self.close()
 
 	def __del__(self):
-		self.close()
+		if not getattr(self, 'closed', True):
+			try:
+				self.close()
+			except IOError:
+				pass
 
 
 if __name__ == '__main__':
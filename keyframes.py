@@ -0,0 +1,424 @@
+import os
+import bisect
+import logging
+import threading
+import numpy as np
+from collections import deque
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+class KeyframeStore(object):
+	"""anchor keyframes of a video: an (N,2) float32 array, a mask of the set
+	frames and a sorted list of their indices.
+
+	indexing works like the list of None / np.float32 it replaces. finding
+	the keyframe before or after a frame is a bisect, and ranges are set,
+	cleared and read in bulk.
+	"""
+
+	def __init__(self, count):
+		self.count = count
+		self.positions = np.zeros((count, 2), dtype=np.float32)
+		self.mask = np.zeros(count, dtype=np.bool_)
+		self.keys = [] # sorted indices of set frames
+		self.version = 0 # counts changes
+		self.listeners = [] # called with (start, stop) after a change
+
+	@classmethod
+	def from_list(cls, keyframes, count):
+		"from the JSON form, a list of None or [x, y]"
+		self = cls(count)
+		keyframes = keyframes[:count]
+		self.keys = [i for i,k in enumerate(keyframes) if k is not None]
+		if self.keys:
+			self.positions[self.keys] = [keyframes[i] for i in self.keys]
+			self.mask[self.keys] = True
+		return self
+
+	def to_list(self):
+		result = [None] * self.count
+		for i in self.keys:
+			result[i] = self.positions[i].tolist()
+		return result
+
+	@classmethod
+	def load_npz(cls, fname, count):
+		data = np.load(fname)
+		self = cls(count)
+		n = min(count, len(data['mask']))
+		self.positions[:n] = data['positions'][:n]
+		self.mask[:n] = data['mask'][:n]
+		self.keys = np.flatnonzero(self.mask).tolist()
+		return self
+
+	def save_npz(self, fname, positions=None, mask=None):
+		"atomically, from copies of the arrays if given (for other threads)"
+		tmpfile = fname + '.tmp'
+		with open(tmpfile, 'wb') as fh:
+			np.savez(fh,
+				positions=self.positions if positions is None else positions,
+				mask=self.mask if mask is None else mask)
+		if os.name == 'nt' and os.path.exists(fname):
+			os.unlink(fname)
+		os.rename(tmpfile, fname)
+
+	def _changed(self, start, stop):
+		self.version += 1
+		for listener in self.listeners:
+			listener(start, stop)
+
+	def __len__(self):
+		return self.count
+
+	def __getitem__(self, index):
+		if not self.mask[index]:
+			return None
+		return self.positions[index].copy()
+
+	def __setitem__(self, index, value):
+		if value is None:
+			if self.mask[index]:
+				self.mask[index] = False
+				del self.keys[bisect.bisect_left(self.keys, index)]
+				self._changed(index, index+1)
+			return
+
+		if not self.mask[index]:
+			self.mask[index] = True
+			bisect.insort(self.keys, index)
+		self.positions[index] = value
+		self._changed(index, index+1)
+
+	def __contains__(self, index):
+		return (0 <= index < self.count) and bool(self.mask[index])
+
+	def same_as(self, other):
+		"the same frames set, to the same positions"
+		return np.array_equal(self.mask, other.mask) and \
+			np.array_equal(self.positions[self.mask], other.positions[other.mask])
+
+	def prev_key(self, index):
+		"last set frame at or before index, or None"
+		i = bisect.bisect_right(self.keys, index) - 1
+		return self.keys[i] if (i >= 0) else None
+
+	def next_key(self, index):
+		"first set frame at or after index, or None"
+		i = bisect.bisect_left(self.keys, index)
+		return self.keys[i] if (i < len(self.keys)) else None
+
+	def keys_in(self, start, stop):
+		"indices and positions of the set frames in [start, stop)"
+		lo = bisect.bisect_left(self.keys, start)
+		hi = bisect.bisect_left(self.keys, stop)
+		keys = np.array(self.keys[lo:hi], dtype=np.int64)
+		return (keys, self.positions[keys])
+
+	def _clip(self, start, stop):
+		return (max(0, start), min(self.count, stop))
+
+	def get_range(self, start, stop):
+		"(positions, mask) copies for [start, stop)"
+		(start, stop) = self._clip(start, stop)
+		return (self.positions[start:stop].copy(), self.mask[start:stop].copy())
+
+	def set_range(self, start, positions, mask=None):
+		"""sets frames from start on. with a mask, frames where it's False are
+		cleared, so a get_range result can be put back."""
+		positions = np.asarray(positions, dtype=np.float32)
+		if mask is None:
+			mask = np.ones(len(positions), dtype=np.bool_)
+		stop = start + len(positions)
+
+		# drop what falls outside the video
+		(cstart, cstop) = self._clip(start, stop)
+		positions = positions[cstart-start : cstop-start]
+		mask = mask[cstart-start : cstop-start]
+		(start, stop) = (cstart, cstop)
+		if start >= stop: return
+
+		self.positions[start:stop][mask] = positions[mask]
+		self.mask[start:stop] = mask
+		self._reindex(start, stop)
+		self._changed(start, stop)
+
+	def clear_range(self, start, stop):
+		(start, stop) = self._clip(start, stop)
+		if start >= stop: return
+		self.mask[start:stop] = False
+		self._reindex(start, stop)
+		self._changed(start, stop)
+
+	def _reindex(self, start, stop):
+		lo = bisect.bisect_left(self.keys, start)
+		hi = bisect.bisect_left(self.keys, stop)
+		self.keys[lo:hi] = (np.flatnonzero(self.mask[start:stop]) + start).tolist()
+
+
+class KeyframeJournal(object):
+	"""crash-safe persistence of a KeyframeStore: an .npz snapshot plus an
+	append-only journal of fixed-size records, written on every change.
+
+	compaction rotates the journal to <journal>.old, writes a new snapshot
+	from copies of the arrays in a thread and then drops the old journal.
+	after a crash anywhere in between, snapshot + old journal + journal
+	still replay to the last change: records hold absolute values, replaying
+	ones the snapshot already has changes nothing.
+	"""
+
+	# CLEAR [start, stop), or SET frame start to (x, y)
+	SET = 1
+	CLEAR = 2
+	record = np.dtype([('op', '<i4'), ('start', '<i4'), ('stop', '<i4'), ('x', '<f4'), ('y', '<f4')])
+
+	def __init__(self, store, snapshotfile, journalfile=None, compact_records=2**16):
+		self.store = store
+		self.snapshotfile = snapshotfile
+		self.journalfile = journalfile or (os.path.splitext(snapshotfile)[0] + '.journal')
+		self.compact_records = compact_records
+		self.records = 0
+		self.fd = None
+		self.compactor = None
+
+	@classmethod
+	def load(cls, snapshotfile, count, **kwargs):
+		"the store as of the last change, read only"
+		if os.path.exists(snapshotfile):
+			store = KeyframeStore.load_npz(snapshotfile, count)
+		else: # only journals
+			store = KeyframeStore(count)
+		self = cls(store, snapshotfile, **kwargs)
+		for fname in (self.journalfile + '.old', self.journalfile):
+			if os.path.exists(fname):
+				n = self.replay(fname)
+				log.info("keyframes: replayed %d edits from %s", n, fname)
+		return self.store
+
+	@classmethod
+	def open(cls, snapshotfile, count, store=None, **kwargs):
+		"""loads snapshot and journals, or starts from store (an import).
+		the journal is attached to the store from then on."""
+		imported = store is not None
+		if not imported:
+			store = cls.load(snapshotfile, count, **kwargs)
+		self = cls(store, snapshotfile, **kwargs)
+		if imported:
+			self._set_aside(count)
+
+		# a clean start: everything in one snapshot, an empty journal
+		self.store.save_npz(self.snapshotfile)
+		for fname in (self.journalfile + '.old', self.journalfile):
+			if os.path.exists(fname):
+				os.unlink(fname)
+		self._open_journal()
+
+		store.listeners.append(self.on_change)
+		return self
+
+	def _set_aside(self, count):
+		"""an import replaces snapshot and journals. if the journals hold
+		edits it doesn't have (a crashed session's), they are renamed to .bak,
+		with the snapshot they apply to, instead of being dropped"""
+		journals = [fname for fname in (self.journalfile + '.old', self.journalfile)
+			if os.path.exists(fname) and os.path.getsize(fname) >= self.record.itemsize]
+		if not journals:
+			return
+
+		persisted = self.load(self.snapshotfile, count, journalfile=self.journalfile)
+		if persisted.same_as(self.store):
+			log.info("keyframes: the import has the journal's edits")
+			return
+
+		# named so that load(snapshot.bak, journalfile=journal.bak) recovers them
+		(snapshotbak, journalbak) = (self.snapshotfile + '.bak', self.journalfile + '.bak')
+		renames = [
+			(self.snapshotfile, snapshotbak),
+			(self.journalfile + '.old', journalbak + '.old'),
+			(self.journalfile, journalbak),
+		]
+		for (src, dst) in renames:
+			if os.path.exists(dst):
+				os.unlink(dst)
+			if os.path.exists(src):
+				os.rename(src, dst)
+		log.warning("keyframes: the import differs from the last session's unsaved edits, "
+			"those are kept in %s and %s", snapshotbak, journalbak)
+
+	def replay(self, fname):
+		size = os.path.getsize(fname)
+		# a torn last record is dropped
+		records = np.fromfile(fname, dtype=self.record, count=size // self.record.itemsize)
+		listeners = self.store.listeners
+		self.store.listeners = []
+		try:
+			for (op, start, stop, x, y) in records.tolist():
+				if op == self.SET:
+					self.store[start] = (x, y)
+				elif op == self.CLEAR:
+					self.store.clear_range(start, stop)
+		finally:
+			self.store.listeners = listeners
+		return len(records)
+
+	def _open_journal(self):
+		flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND | getattr(os, 'O_BINARY', 0)
+		self.fd = os.open(self.journalfile, flags)
+		self.records = 0
+
+	def on_change(self, start, stop):
+		store = self.store
+		if stop - start == 1 and store.mask[start]:
+			(keys, values) = (np.array([start]), store.positions[start:stop])
+			records = np.zeros(1, dtype=self.record)
+		else:
+			(keys, values) = store.keys_in(start, stop)
+			records = np.zeros(1 + len(keys), dtype=self.record)
+			records[0] = (self.CLEAR, start, stop, 0, 0)
+
+		sets = records[len(records) - len(keys):]
+		sets['op'] = self.SET
+		sets['start'] = keys
+		sets['stop'] = keys + 1
+		sets['x'] = values[:,0]
+		sets['y'] = values[:,1]
+
+		# the OS has it once write returns, a crash of this process loses nothing
+		os.write(self.fd, records.tostring())
+		self.records += len(records)
+
+		if self.records >= self.compact_records:
+			self.compact()
+
+	def compact(self):
+		"snapshot in the background, the journal starts over"
+		if self.compactor is not None:
+			self.compactor.join()
+
+		os.close(self.fd)
+		oldfile = self.journalfile + '.old'
+		if os.path.exists(oldfile):
+			# a compaction failed, its edits aren't in the snapshot yet
+			with open(oldfile, 'ab') as fh:
+				fh.write(open(self.journalfile, 'rb').read())
+			os.unlink(self.journalfile)
+		else:
+			os.rename(self.journalfile, oldfile)
+		self._open_journal()
+
+		positions = self.store.positions.copy()
+		mask = self.store.mask.copy()
+
+		def run():
+			self.store.save_npz(self.snapshotfile, positions, mask)
+			os.unlink(oldfile)
+
+		self.compactor = threading.Thread(target=run, name="keyframe compaction")
+		self.compactor.start()
+
+	def close(self):
+		"final snapshot, nothing left to replay"
+		self.compact()
+		self.compactor.join()
+		os.close(self.fd)
+		self.fd = None
+		self.store.listeners.remove(self.on_change)
+
+
+class Edit(object):
+	"one undoable change: frames [start, stop) before and after"
+	__slots__ = ('start', 'stop', 'old', 'new', 'label', 'tag')
+
+	def __init__(self, start, stop, old, new, label, tag):
+		self.start = start
+		self.stop = stop
+		self.old = old # (positions, mask)
+		self.new = new
+		self.label = label
+		self.tag = tag
+
+	@property
+	def nbytes(self):
+		return sum(a.nbytes for a in self.old + self.new)
+
+
+class EditHistory(object):
+	"""undo/redo for a KeyframeStore, as range deltas in a byte budget.
+
+	the oldest edits are dropped when the budget is exceeded. consecutive
+	edits with the same tag (a mouse drag) are merged into one, as long as
+	their ranges are close.
+	"""
+
+	merge_gap = 256 # frames between merged ranges
+
+	def __init__(self, store, maxbytes=16 * 2**20):
+		self.store = store
+		self.maxbytes = maxbytes
+		self.nbytes = 0
+		self.undos = deque()
+		self.redos = deque()
+		self.mergeable = False # undos[-1] is the last thing that happened
+
+	@contextmanager
+	def change(self, start, stop, label, tag=None):
+		"records what the body does to frames [start, stop)"
+		(start, stop) = (max(0, start), min(self.store.count, stop))
+		if start >= stop:
+			yield
+			return
+
+		old = self.store.get_range(start, stop)
+		yield
+
+		if tag is not None and self.mergeable and self.undos[-1].tag == tag:
+			if self._merge(self.undos[-1], start, stop, old):
+				return
+
+		self._push(Edit(start, stop, old, self.store.get_range(start, stop), label, tag))
+
+	def _push(self, edit):
+		self.undos.append(edit)
+		self.nbytes += edit.nbytes
+		self.redos.clear()
+		self.mergeable = True
+		while self.nbytes > self.maxbytes and len(self.undos) > 1:
+			self.nbytes -= self.undos.popleft().nbytes
+
+	def _merge(self, edit, start, stop, old):
+		(ustart, ustop) = (min(edit.start, start), max(edit.stop, stop))
+		if ustop - ustart > (edit.stop - edit.start) + (stop - start) + self.merge_gap:
+			return False
+
+		# nothing else happened in between: the store has the new state, and
+		# the old one where neither edit touched it
+		new = self.store.get_range(ustart, ustop)
+		(positions, mask) = (new[0].copy(), new[1].copy())
+		for (s, (p, m)) in ((start, old), (edit.start, edit.old)): # oldest last
+			positions[s-ustart : s-ustart+len(m)] = p
+			mask[s-ustart : s-ustart+len(m)] = m
+
+		self.nbytes -= edit.nbytes
+		(edit.start, edit.stop, edit.old, edit.new) = (ustart, ustop, (positions, mask), new)
+		self.nbytes += edit.nbytes
+		self.redos.clear()
+		return True
+
+	def undo(self):
+		"the undone edit's label, or None"
+		if not self.undos: return None
+		edit = self.undos.pop()
+		self.nbytes -= edit.nbytes
+		self.store.set_range(edit.start, *edit.old)
+		self.redos.append(edit)
+		self.mergeable = False
+		return edit.label
+
+	def redo(self):
+		if not self.redos: return None
+		edit = self.redos.pop()
+		self.store.set_range(edit.start, *edit.new)
+		self.undos.append(edit)
+		self.nbytes += edit.nbytes
+		self.mergeable = False
+		return edit.label
@@ -25,17 +25,24 @@ import numpy as np
 import cv2
 from opencv_common import draw_str, RectSelector
 
-def rnd_warp(a):
+def rnd_warps(a, count, rng=np.random):
+    '''count random affine warps of a, as a (count, h, w) stack. the
+    matrices are drawn in one batch, warpAffine fills the stack'''
     h, w = a.shape[:2]
-    T = np.zeros((2, 3))
     coef = 0.2
-    ang = (np.random.rand()-0.5)*coef
+    # per warp an angle and a 2x2 jitter, the same stream as drawing them one warp at a time
+    r = rng.rand(count, 5)
+    ang = (r[:, 0]-0.5)*coef
     c, s = np.cos(ang), np.sin(ang)
-    T[:2, :2] = [[c,-s], [s, c]]
-    T[:2, :2] += (np.random.rand(2, 2) - 0.5)*coef
-    c = (w/2, h/2)
-    T[:,2] = c - np.dot(T[:2, :2], c)
-    return cv2.warpAffine(a, T, (w, h), borderMode = cv2.BORDER_REFLECT)
+    T = np.zeros((count, 2, 3))
+    T[:, 0, 0], T[:, 0, 1], T[:, 1, 0], T[:, 1, 1] = c, -s, s, c
+    T[:, :, :2] += (r[:, 1:].reshape(count, 2, 2) - 0.5)*coef
+    c = np.float64([w/2, h/2])
+    T[:, :, 2] = c - np.dot(T[:, :, :2], c)
+    warped = np.empty((count, h, w), a.dtype)
+    for i in xrange(count):
+        cv2.warpAffine(a, T[i], (w, h), dst=warped[i], borderMode = cv2.BORDER_REFLECT)
+    return warped
 
 def divSpec(A, B):
     Ar, Ai = A[...,0], A[...,1]
@@ -52,8 +59,72 @@ def vertex(x2, y1, y2, y3):
 def fix8(*s):
     return tuple(int(round(x * 256)) for x in s)
 
+def draw_target(vis, pos, size, good, psr, scale=1, color=(0, 0, 255)):
+    (x, y), (w, h) = pos, size
+    x *= scale
+    y *= scale
+    w *= scale
+    h *= scale
+    x1, y1, x2, y2 = (x-0.5*w), (y-0.5*h), (x+0.5*w), (y+0.5*h)
+    cv2.rectangle(vis,
+        fix8(x1, y1),
+        fix8(x2, y2),
+        color, thickness=2, shift=8)
+    if good:
+        cv2.circle(vis,
+            fix8(int(x), int(y)),
+            fix8(4)[0],
+            color, -1, shift=8)
+    else:
+        cv2.line(vis,
+            fix8(x1, y1),
+            fix8(x2, y2),
+            color, thickness=2, shift=8)
+        cv2.line(vis,
+            fix8(x2, y1),
+            fix8(x1, y2),
+            color, thickness=2, shift=8)
+
+    draw_str(vis, (int(x1), int(y2+32)), 'PSR: %.2f' % psr)
+
+def preprocess_stack(imgs, win):
+    '''MOSSE.preprocess of a (n, h, w) stack of windows'''
+    (n, h, w) = imgs.shape
+    imgs = cv2.log(np.float32(imgs).reshape(n*h, w) + 1.0).reshape(n, h, w)
+    flat = imgs.reshape(n, -1)
+    mean, std = flat.mean(axis=1), flat.std(axis=1)
+    imgs -= mean[:,None,None]
+    imgs *= win / (std[:,None,None]+eps)
+    return imgs
+
+def spectra(imgs):
+    '''complex (n, h, w) spectra of a stack of real windows'''
+    return np.array([cv2.dft(img, flags=cv2.DFT_COMPLEX_OUTPUT) for img in imgs]).view(np.complex64)[...,0]
+
+def responses(C):
+    '''real inverses of a complex64 stack of spectra'''
+    planes = C[...,None].view(np.float32) # cv2's 2-channel layout, no copy
+    return np.array([cv2.idft(c, flags=cv2.DFT_SCALE | cv2.DFT_REAL_OUTPUT) for c in planes])
+
+def train(img, win, G, count=128, rng=np.random):
+    '''MOSSE's initial H1 and H2 (cv2 layout), from count random warps of img'''
+    a = preprocess_stack(rnd_warps(img, count, rng), win)
+    # H1 is linear in the windows, one transform of their sum does
+    A = cv2.dft(a.sum(axis=0), flags=cv2.DFT_COMPLEX_OUTPUT)
+    H1 = cv2.mulSpectrums(G, A, 0, conjB=True)
+    # H2 sums power spectra, in the packed real format (half the work),
+    # unpacked once at the end
+    H2 = np.zeros(a.shape[1:], np.float32)
+    for window in a:
+        A = cv2.dft(window)
+        H2 += cv2.mulSpectrums(A, A, 0, conjB=True)
+    H2 = cv2.idft(H2, flags=cv2.DFT_SCALE | cv2.DFT_REAL_OUTPUT)
+    H2 = cv2.dft(H2, flags=cv2.DFT_COMPLEX_OUTPUT)
+    H2[...,1] = 0
+    return H1, H2
+
 class MOSSE:
-    def __init__(self, frame, rect):
+    def __init__(self, frame, rect, warps=128, seed=None):
         x1, y1, x2, y2 = rect
         w, h = map(cv2.getOptimalDFTSize, [int(x2-x1), int(y2-y1)])
         self.pos = x, y = np.float32([x1+x2, y1+y2]) / 2.0
@@ -67,13 +138,8 @@ class MOSSE:
         g /= g.max()
 
         self.G = cv2.dft(g, flags=cv2.DFT_COMPLEX_OUTPUT)
-        self.H1 = np.zeros_like(self.G)
-        self.H2 = np.zeros_like(self.G)
-        for i in xrange(128):
-            a = self.preprocess(rnd_warp(img))
-            A = cv2.dft(a, flags=cv2.DFT_COMPLEX_OUTPUT)
-            self.H1 += cv2.mulSpectrums(self.G, A, 0, conjB=True)
-            self.H2 += cv2.mulSpectrums(     A, A, 0, conjB=True)
+        rng = np.random if (seed is None) else np.random.RandomState(seed)
+        self.H1, self.H2 = train(img, self.win, self.G, warps, rng)
         self.update_kernel()
         self.update(frame)
 
@@ -122,32 +188,7 @@ class MOSSE:
         return vis
 
     def draw_state(self, vis, scale=1):
-        (x, y), (w, h) = self.pos, self.size
-        x *= scale
-        y *= scale
-        w *= scale
-        h *= scale
-        x1, y1, x2, y2 = (x-0.5*w), (y-0.5*h), (x+0.5*w), (y+0.5*h)
-        cv2.rectangle(vis,
-            fix8(x1, y1),
-            fix8(x2, y2),
-            (0, 0, 255), thickness=2, shift=8)
-        if self.good:
-            cv2.circle(vis,
-                fix8(int(x), int(y)),
-                fix8(4)[0],
-                (0, 0, 255), -1, shift=8)
-        else:
-            cv2.line(vis,
-                fix8(x1, y1),
-                fix8(x2, y2),
-                (0, 0, 255), thickness=2, shift=8)
-            cv2.line(vis,
-                fix8(x2, y1),
-                fix8(x1, y2),
-                (0, 0, 255), thickness=2, shift=8)
-
-        draw_str(vis, (int(x1), int(y2+32)), 'PSR: %.2f' % self.psr)
+        draw_target(vis, self.pos, self.size, self.good, self.psr, scale)
 
     def preprocess(self, img):
         img = np.log(np.float32(img)+1.0)
@@ -172,19 +213,228 @@ class MOSSE:
         self.H = divSpec(self.H1, self.H2)
         self.H[...,1] *= -1
 
+class MOSSETarget:
+    '''one target of a MOSSEGroup, its filter lives in the group's stack'''
+    def __init__(self, pos, size):
+        self.pos = np.float32(pos)
+        self.size = size
+        self.stack = None
+        self.psr = 0.0
+        self.good = False
+        self.last_img = None
+        self.last_resp = None
+
+    @property
+    def H(self):
+        return self.stack.H[self.stack.targets.index(self)]
+
+    @property
+    def state_vis(self):
+        f = responses(np.conj(self.H)[None])[0]
+        h, w = f.shape
+        f = np.roll(f, -h//2, 0)
+        f = np.roll(f, -w//2, 1)
+        kernel = np.uint8( (f-f.min()) / f.ptp()*255 )
+        resp = self.last_resp
+        resp = np.uint8(np.clip(resp/resp.max(), 0, 1)*255)
+        vis = np.hstack([self.last_img, kernel, resp])
+        return vis
+
+    def draw_state(self, vis, scale=1, color=(0, 0, 255)):
+        draw_target(vis, self.pos, self.size, self.good, self.psr, scale, color)
+
+class MOSSEStack:
+    '''filters of the same-size targets of a MOSSEGroup, as (n, h, w)
+    complex64 arrays. H = H1/H2 is the conjugate of MOSSE.H, so correlating
+    is a plain product with a window's spectrum.'''
+    def __init__(self, size, win, G):
+        (w, h) = self.size = size
+        self.win = win
+        self.G = G
+        self.targets = []
+        self.H1 = np.zeros((0, h, w), np.complex64)
+        self.H2 = np.zeros((0, h, w), np.float32)
+        self.H = self.H1.copy()
+
+    def append(self, target, H1, H2):
+        target.stack = self
+        self.targets.append(target)
+        self.H1 = np.concatenate([self.H1, H1[None]])
+        self.H2 = np.concatenate([self.H2, H2[None]])
+        self.H = self.H1 / self.H2
+
+    def remove(self, target):
+        j = self.targets.index(target)
+        del self.targets[j]
+        self.H1 = np.delete(self.H1, j, axis=0)
+        self.H2 = np.delete(self.H2, j, axis=0)
+        self.H = np.delete(self.H, j, axis=0)
+
+class MOSSEGroup:
+    '''MOSSE tracking of several targets in the same frames.
+
+    targets with the same window size form a stack: their windows are
+    preprocessed together, correlated with the stacked filters in one
+    product, and peak, sub-pixel offset and PSR are found for the whole
+    stack at once. only cutting out the windows and the transforms (cv2's,
+    which beat numpy's double precision FFTs) are per target.
+
+    positions and masks are arrays in the order of self.targets.
+    '''
+    def __init__(self):
+        self.targets = []
+        self.stacks = {} # size -> MOSSEStack
+        self.best = None # index of the highest PSR, of the last track()
+
+    def __len__(self):
+        return len(self.targets)
+
+    def add(self, frame, rect, warps=128, seed=None):
+        # trains as a single MOSSE, then takes over its filter
+        mosse = MOSSE(frame, rect, warps, seed)
+        size = mosse.size
+
+        target = MOSSETarget(mosse.pos, size)
+        (target.last_img, target.last_resp) = (mosse.last_img, mosse.last_resp)
+        (target.psr, target.good) = (mosse.psr, mosse.good)
+
+        if size not in self.stacks:
+            self.stacks[size] = MOSSEStack(size, mosse.win, mosse.G.view(np.complex64)[...,0])
+        H1 = mosse.H1.view(np.complex64)[...,0]
+        H2 = mosse.H2[...,0]
+        self.stacks[size].append(target, H1, H2)
+
+        self.targets.append(target)
+        if self.best is None:
+            self.best = len(self.targets) - 1
+        return target
+
+    def remove(self, index):
+        target = self.targets.pop(index)
+        stack = target.stack
+        stack.remove(target)
+        if not stack.targets:
+            del self.stacks[stack.size]
+        self.best = None
+
+    @property
+    def good(self):
+        return (self.best is not None) and self.targets[self.best].good
+
+    def indices(self, stack):
+        '''positions in self.targets of the stack's targets'''
+        order = dict((id(t), i) for (i, t) in enumerate(self.targets))
+        return np.array([order[id(t)] for t in stack.targets], int)
+
+    def windows(self, frame, stack, rows, positions):
+        '''preprocessed windows of the stack's targets 'rows', at positions'''
+        (w, h) = stack.size
+        imgs = np.array([cv2.getRectSubPix(frame, (w, h), tuple(p)) for p in positions])
+        for (j, img) in zip(rows, imgs):
+            stack.targets[j].last_img = img
+        return preprocess_stack(imgs, stack.win)
+
+    def track(self, frame, positions=None):
+        '''(dx, dy) of every target, searched around positions (default:
+        their own). sets psr, good and last_resp of each, and self.best.'''
+        n = len(self.targets)
+        if positions is None:
+            positions = [target.pos for target in self.targets]
+        positions = np.float32(positions).reshape(n, 2)
+        deltas = np.zeros((n, 2), np.float32)
+
+        for stack in self.stacks.values():
+            (w, h) = stack.size
+            k = len(stack.targets)
+            indices = self.indices(stack)
+            F = spectra(self.windows(frame, stack, xrange(k), positions[indices]))
+            F *= stack.H
+            resp = responses(F)
+
+            flat = resp.reshape(k, -1)
+            peak = flat.argmax(axis=1)
+            (my, mx) = np.divmod(peak, w)
+            r = np.arange(k)
+            mval = flat[r, peak]
+
+            # sub-pixel peak, where both neighbours exist
+            with np.errstate(divide='ignore', invalid='ignore'):
+                (y1, y3) = resp[r, my, np.maximum(mx-1, 0)], resp[r, my, np.minimum(mx+1, w-1)]
+                fmx = np.where((mx >= 1) & (mx <= w-2), mx + 0.5 * (y3 - y1) / (2*mval - y1 - y3), mx)
+                (y1, y3) = resp[r, np.maximum(my-1, 0), mx], resp[r, np.minimum(my+1, h-1), mx]
+                fmy = np.where((my >= 1) & (my <= h-2), my + 0.5 * (y3 - y1) / (2*mval - y1 - y3), my)
+
+            # PSR: mean and deviation of the response with the 11x11 around the peak zeroed
+            near = (np.abs(np.arange(h)[None,:] - my[:,None]) <= 5)[:,:,None] \
+                 & (np.abs(np.arange(w)[None,:] - mx[:,None]) <= 5)[:,None,:]
+            side = np.where(near, np.float32(0), resp).reshape(k, -1)
+            psr = (mval - side.mean(axis=1)) / (side.std(axis=1)+eps)
+
+            for (j, target) in enumerate(stack.targets):
+                target.last_resp = resp[j]
+                target.psr = float(psr[j])
+                target.good = target.psr > 8.0
+            deltas[indices, 0] = fmx - w//2
+            deltas[indices, 1] = fmy - h//2
+
+        self.best = max(xrange(n), key=lambda i: self.targets[i].psr) if n else None
+        return deltas
+
+    def adapt(self, frame, positions, rate=0.125, which=None):
+        '''moves the targets to positions and trains their filters there.
+        which: mask of the targets to adapt, default all.'''
+        n = len(self.targets)
+        positions = np.float32(positions).reshape(n, 2)
+        which = np.ones(n, bool) if (which is None) else np.asarray(which, bool)
+
+        for stack in self.stacks.values():
+            indices = self.indices(stack)
+            rows = np.flatnonzero(which[indices])
+            if len(rows) == 0: continue
+            A = spectra(self.windows(frame, stack, rows, positions[indices[rows]]))
+
+            # in place when the whole stack adapts, the usual case
+            sel = slice(None) if (len(rows) == len(indices)) else rows
+            H1 = stack.H1[sel]
+            H1 *= (1.0-rate)
+            H1 += np.conj(A) * (stack.G * rate)
+            H2 = stack.H2[sel]
+            H2 *= (1.0-rate)
+            H2 += (A.real**2 + A.imag**2) * rate
+            stack.H1[sel] = H1
+            stack.H2[sel] = H2
+            stack.H[sel] = H1 / H2
+
+            for j in rows:
+                stack.targets[j].pos = positions[indices[j]].copy()
+
+    def update(self, frame, rate=0.125):
+        deltas = self.track(frame)
+        which = np.array([target.good for target in self.targets], bool)
+        positions = np.float32([target.pos for target in self.targets]).reshape(-1, 2) + deltas
+        self.adapt(frame, positions, rate, which)
+
+    @property
+    def state_vis(self):
+        return self.targets[self.best or 0].state_vis
+
+    def draw_state(self, vis, scale=1):
+        # the best target in red, the others in orange
+        for (i, target) in enumerate(self.targets):
+            target.draw_state(vis, scale, (0, 0, 255) if (i == self.best) else (0, 128, 255))
+
 class App:
     def __init__(self, video_src, paused = False):
         self.cap = video.create_capture(video_src)
         _, self.frame = self.cap.read()
         cv2.imshow('frame', self.frame)
         self.rect_sel = RectSelector('frame', self.onrect)
-        self.trackers = []
+        self.trackers = MOSSEGroup()
         self.paused = paused
 
     def onrect(self, rect):
         frame_gray = cv2.cvtColor(self.frame, cv2.COLOR_BGR2GRAY)
-        tracker = MOSSE(frame_gray, rect)
-        self.trackers.append(tracker)
+        self.trackers.add(frame_gray, rect)
 
     def run(self):
         while True:
@@ -193,14 +443,13 @@ class App:
                 if not ret:
                     break
                 frame_gray = cv2.cvtColor(self.frame, cv2.COLOR_BGR2GRAY)
-                for tracker in self.trackers:
-                    tracker.update(frame_gray)
+                if self.trackers:
+                    self.trackers.update(frame_gray)
 
             vis = self.frame.copy()
-            for tracker in self.trackers:
-                tracker.draw_state(vis)
+            self.trackers.draw_state(vis)
             if len(self.trackers) > 0:
-                cv2.imshow('tracker state', self.trackers[-1].state_vis)
+                cv2.imshow('tracker state', self.trackers.state_vis)
             self.rect_sel.draw(vis)
 
             cv2.imshow('frame', vis)
@@ -210,7 +459,7 @@ class App:
             if ch == ord(' '):
                 self.paused = not self.paused
             if ch == ord('c'):
-                self.trackers = []
+                self.trackers = MOSSEGroup()
 
 
 if __name__ == '__main__':
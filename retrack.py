@@ -3,124 +3,46 @@ import os
 import sys
 import time
 import numpy as np
-import scipy.ndimage
 import cv2
 import json
+import logging
+import subprocess
+import bisect
+import signal
+import threading
+import multiprocessing
+import Queue
 from multiprocessing.pool import ThreadPool
 from collections import deque
 import pprint; pp = pprint.pprint
 
-from mosse import MOSSE
+from mosse import MOSSEGroup
 from opencv_common import RectSelector
 
 import ffwriter
-from cachingvideoreader import RateChangedVideo
+import trajectory
+from trajectory import TrajectoryCache
+from smoothing import Smoother
+from keyframes import KeyframeStore, KeyframeJournal, EditHistory
+from ffreader import FFReader
+from cachingvideoreader import RateChangedVideo, CachingVideoReader, GOPIndex, FrameStore, StripeStore, file_signature
 
 ########################################################################
 
 
-class VideoSource(object):
-	def __init__(self, vid, numcache=100, numstep=25, equalize=False):
-		self.vid = vid
-		self.index = -1 # just for relative addressing
-		self.numcache = numcache
-		self.numstep = numstep
-		self.equalize = equalize
-		self.cache = {} # index -> frame
-		#self.stripes = {} # index -> row
-		self.mru = [] # oldest -> newest
-	
-	def cache_range(self, start, stop):
-		if start < 0: start = 0
-		if stop >= totalframes: stop = totalframes-1
-		assert start <= stop
-		requested = range(start, stop+1)
-		requested = [i for i in requested if i not in self.cache]
-		if not requested: return
-		start = min(requested)
-		stop = max(requested)
-		requested = range(start, stop+1)
-		vidpos = self.vid.tell()
-		if start != vidpos:
-			print "cache_range: seeking from {0} to {1}".format(vidpos, start)
-			self.vid.seek(start)
-		for i in requested:
-			rv = self.vid.grab()
-			if not rv: continue
-			if i not in self.cache:
-				(rv, frame) = self.vid.retrieve()
-				if rv:
-					if self.equalize:
-						frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-						frame = cv2.equalizeHist(frame)
-						frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
-					self.cache[i] = frame
-		
-		self.mru = [i for i in self.mru if i not in requested] + requested
-
-	def _prefetch(self, newindex):
-		rel = newindex - self.index
+class VideoSource(CachingVideoReader):
+	"CachingVideoReader, with reads relative to the last one"
 
-		if rel < 0:
-			do_prefetch = not all(i in self.cache for i in xrange(newindex-1, newindex+1))
-		
-			if do_prefetch:
-				upcoming = range(newindex-self.numstep, newindex+1)
-				print "prefetching"
-				self.vid.seek(newindex-self.numstep)
-				for i in upcoming:
-					if i in self.cache:
-						#print "grabbing frame {0}".format(i)
-						self.vid.grab()
-					else:
-						#print "reading frame {0}".format(i)
-						(rv, frame) = self.vid.read()
-						if rv:
-							if self.equalize:
-								frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-								frame = cv2.equalizeHist(frame)
-								frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
-							self.cache[i] = frame
-				
-				self.mru = [i for i in self.mru if i not in upcoming] + upcoming
-		
-		if newindex not in self.cache:
-			vidpos = self.vid.tell()
-			if vidpos != newindex:
-				print "seeking to {0}".format(newindex)
-				self.vid.seek(newindex)
-			
-			#print "reading frame {0}".format(newindex)
-			(rv,frame) = self.vid.read()
-			if rv:
-				if self.equalize:
-					frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-					frame = cv2.equalizeHist(frame)
-					frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
-				self.cache[newindex] = frame
-			else:
-				return
-			
-		self.mru = [i for i in self.mru if i != newindex] + [newindex]
-			
-		self.mru = self.mru[-self.numcache:]
-		self.cache = { i: frame for i,frame in self.cache.iteritems() if i in self.mru }
-		#self.stripes = {i: self.stripes[i] for i in self.mru}
-			
 	def read(self, newindex=None):
 		if newindex is None:
 			newindex = self.index + 1
 
-		if not (0 <= newindex < totalframes):
-			return None
+		return self.get(newindex)
 
-		self._prefetch(newindex)
-		self.index = newindex
-		
-		if self.index not in self.cache:
-			return None
-		
-		return self.cache[self.index]
+def equalize_frame(frame):
+	frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+	frame = cv2.equalizeHist(frame)
+	return cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
 
 ########################################################################
 
@@ -143,6 +65,35 @@ def fix8(a):
 	else:
 		return tuple((np.array(a) * 256).round().astype(np.int32))
 
+def pfix8(a):
+	"fix8 for source coordinates, drawn onto a (proxy) frame"
+	return fix8(np.float32(a) * proxyscale)
+
+def graph_row(index, frame=None):
+	"x-t graph row of a frame at its anchor's y, or None if it's not stored"
+	y = get_keyframe(index)[1] * proxyscale
+	row = stripes.get(index, y)
+	if row is None and frame is not None: # anchor moved away from the stored rows
+		stripes.put(index, frame, y)
+		row = stripes.get(index, y)
+	return row
+
+def cache_stripes(imin, imax, background=False):
+	"decodes what the graph is missing in [imin, imax]"
+	imin = max(imin, 0)
+	imax = min(imax, totalframes-1)
+	missing = [i for i in xrange(imin, imax+1) if graph_row(i, src.peek(i)) is None]
+	if not missing:
+		return
+	if background:
+		src.prefetch(missing[0], missing[-1])
+	else:
+		src.get_range(missing[0], missing[-1])
+
+def store_stripe(index, frame):
+	# called for every frame entering the cache
+	stripes.put(index, frame, get_keyframe(index)[1] * proxyscale)
+
 def redraw_display():
 	#print "redraw"
 	if mousedown:
@@ -152,41 +103,20 @@ def redraw_display():
 
 	# anchor is animated
 
-	(xmin, xmax) = meta['anchor_x_range']
-	(ymin, ymax) = meta['anchor_y_range']
-
-	# anchor within bounds
-	(ax, ay) = canchor = np.clip(anchor, [xmin, ymin], [xmax, ymax])
+	# the output as rendered: within bounds and smoothed
+	canchor = final_trajectory.get(src.index, src.index+1)[0]
 
 	# anchor cross will be updated
 	cpos = np.float32(position) + (anchor - canchor) * meta['scale']
 	# *scale to compensate the offset in screen space
 
-	Anchor = np.matrix([
-		[1, 0, -ax],
-		[0, 1, -ay],
-		[0, 0, 1.0],
-	])
-	InvAnchor = np.linalg.inv(Anchor)
-	scale = meta['scale']
-	Scale = np.matrix([
-		[scale, 0, 0],
-		[0, scale, 0],
-		[0, 0, 1.0]
-	])
-	
-	# position is fixed in meta
-	Translate = np.matrix([
-		[1, 0, position[0]],
-		[0, 1, position[1]],
-		[0, 0, 1.0]
-	])
-	
-	M = Translate * Scale * Anchor
-	InvM = np.linalg.inv(M)
+	M = transform_matrix(canchor)
 
 	if draw_output:
-		surface = cv2.warpAffine(curframe, M[0:2,:], (screenw, screenh), flags=cv2.INTER_AREA)
+		# proxy pixels to source coordinates
+		Mproxy = M.copy()
+		Mproxy[:, 0:2] /= proxyscale
+		surface = warp_crop(curframe, Mproxy, (screenw, screenh), cv2.INTER_AREA, subpixel=False)
 		
 		cv2.line(surface,
 			fix8(cpos + (+10, +10)),
@@ -206,67 +136,71 @@ def redraw_display():
 		cv2.imshow("output", surface)
 
 	if draw_input and curframe is not None:
+		# curframe may be a proxy, points are in source coordinates
 		source = curframe.copy()
+		(sh, sw) = source.shape[:2]
+		lw = max(1, iround(proxyscale / dispscale))
 
 		cv2.line(source,
-			fix8(anchor - 10),
-			fix8(anchor + 10), 
-			cursorcolor,  thickness=iround(1/dispscale), shift=8, lineType=cv2.LINE_AA)
+			pfix8(anchor - 10),
+			pfix8(anchor + 10), 
+			cursorcolor,  thickness=lw, shift=8, lineType=cv2.LINE_AA)
 		cv2.line(source,
-			fix8(anchor + (+10, -10)),
-			fix8(anchor - (+10, -10)),
-			cursorcolor,  thickness=iround(1/dispscale), shift=8, lineType=cv2.LINE_AA)
+			pfix8(anchor + (+10, -10)),
+			pfix8(anchor - (+10, -10)),
+			cursorcolor,  thickness=lw, shift=8, lineType=cv2.LINE_AA)
 
-		TL = InvM * np.matrix([[0, 0, 1]]).T
-		BR = InvM * np.matrix([[screenw, screenh, 1]]).T
+		InvM = cv2.invertAffineTransform(M)
+		TL = InvM.dot([0, 0, 1])
+		BR = InvM.dot([screenw, screenh, 1])
 
 		cv2.rectangle(source,
-			fix8(np.array(TL)[0:2,0]),
-			fix8(np.array(BR)[0:2,0]),
-			(255, 0, 0), thickness=iround(1/dispscale), shift=8, lineType=cv2.LINE_AA)
+			pfix8(TL),
+			pfix8(BR),
+			(255, 0, 0), thickness=lw, shift=8, lineType=cv2.LINE_AA)
 
 		secs = src.index / framerate
 		hours, secs = divmod(secs, 3600)
 		mins, secs = divmod(secs, 60)
 		cv2.rectangle(source,
-			(0, srch),
-			(srcw, srch-70),
+			(0, sh),
+			(sw, sh-iround(70*proxyscale)),
 			(0,0,0), cv2.FILLED)
 
 		text = "{h:.0f}:{m:02.0f}:{s:06.3f} / frame {frame}".format(h=hours, m=mins, s=secs, frame=src.index)
 		cv2.putText(source,
 			text,
-			(10, srch-10), cv2.FONT_HERSHEY_PLAIN, 4, (255,255,255), 3)
+			(10, sh-10), cv2.FONT_HERSHEY_PLAIN, 4*proxyscale, (255,255,255), max(1, iround(3*proxyscale)))
 
 		if use_faces:
 			# faces are in source coordinates and scale
 			if faces_roi is not None:
 				cv2.rectangle(source,
-					fix8(faces_roi[0:2]), fix8(faces_roi[2:4]),
-					(0, 0, 160), thickness=iround(1/dispscale), shift=8, lineType=cv2.LINE_AA)
+					pfix8(faces_roi[0:2]), pfix8(faces_roi[2:4]),
+					(0, 0, 160), thickness=lw, shift=8, lineType=cv2.LINE_AA)
 
 			for face in faces:
 				facewh = face[2:4] - face[0:2]
 				fanchor = face[0:2] + facewh * face_anchor
 
 				cv2.polylines(source,
-					fix8([
+					pfix8([
 						[fanchor + facewh * 0.05, fanchor - facewh * 0.05],
 						[fanchor + facewh * (+1,-1) * 0.05, fanchor - facewh * (+1,-1) * 0.05]
 					]),
 					False,
-					(0, 255, 0), thickness=iround(1/dispscale), shift=8, lineType=cv2.LINE_AA)
+					(0, 255, 0), thickness=lw, shift=8, lineType=cv2.LINE_AA)
 
 				cv2.rectangle(source,
-					fix8(face[0:2]), fix8(face[2:4]),
-					(0, 255, 0), thickness=iround(1/dispscale), shift=8, lineType=cv2.LINE_AA)
+					pfix8(face[0:2]), pfix8(face[2:4]),
+					(0, 255, 0), thickness=lw, shift=8, lineType=cv2.LINE_AA)
 
 		if use_tracker:
 			tracker_rectsel.draw(source)
 
 		if tracker:
 			# scale to source resolution
-			tracker.draw_state(source, 1 / trackerscale)
+			tracker.draw_state(source, proxyscale / trackerscale)
 
 		cv2.imshow("source", source)
 	
@@ -285,15 +219,13 @@ def redraw_display():
 
 		if graphbg is None: # full redraw
 			t0 = time.clock()
-			graphbg = [
-				src.cache[i][np.clip(get_keyframe(i)[1], 0, srch-1)] if (i in src.cache) else emptyrow
-				for i in indices
-			]
+			rows = [graph_row(i) for i in indices]
+			graphbg = [emptyrow if (row is None) else row for row in rows]
 			t1 = time.clock()
 			graphbg = np.array(graphbg, dtype=np.uint8)
 			t2 = time.clock()
 			graphbg_head = imax
-			graphbg_indices = set(indices) & set(src.cache)
+			graphbg_indices = set(i for i,row in zip(indices, rows) if row is not None)
 			
 			print "graphbg redraw {0:.3f} {1:.3f}".format(t1-t0, t2-t1)
 		
@@ -315,30 +247,31 @@ def redraw_display():
 				newindices = xrange(imin+ashift, imin, -1)
 				graphbg_indices = set(i for i in graphbg_indices if i <= imax)
 			
-			replacements = [
-				src.cache[i][np.clip(get_keyframe(i)[1], 0, srch-1)] if (i in src.cache) else emptyrow
-				for i in newindices
-			]
-			graphbg_indices.update( set(newindices) & set(src.cache) )
+			rows = [graph_row(i) for i in newindices]
+			replacements = [emptyrow if (row is None) else row for row in rows]
+			graphbg_indices.update(i for i,row in zip(newindices, rows) if row is not None)
 
 			if shift > 0:
 				graphbg[:ashift] = replacements
 			elif shift < 0:
 				graphbg[-ashift:] = replacements
 
-		updates = (set(indices) & set(src.cache)) - graphbg_indices
-		if updates:
-			for i in updates:
-				graphbg[graphbg_head - i] = src.cache[i][np.clip(get_keyframe(i)[1], 0, srch-1)]
-			graphbg_indices.update(updates)
+		for i in indices:
+			if (i in graphbg_indices) or (i not in stripes): continue
+			row = graph_row(i)
+			if row is not None:
+				graphbg[graphbg_head - i] = row
+				graphbg_indices.add(i)
 		
 		graph = cv2.resize(graphbg, (srcw, graphheight), interpolation=cv2.INTER_NEAREST)
 
-		lineindices = [i for i in range(imin, imax+1) if (0 <= i < totalframes) and keyframes[i] is not None]
+		(lineindices, linepoints) = keyframes.keys_in(imin, imax+1)
 		lines = np.int32([
-			fix8([ keyframes[index][0], (imax - index) * graphscale ])
-			for index in lineindices
+			fix8([ point[0], (imax - index) * graphscale ])
+			for index,point in zip(lineindices, linepoints)
 		])
+		# positions for the curvature marks, imin-1 .. imax+1
+		curve = get_trajectory(imin-1, imax+2)
 
 		now = (imax - src.index) * graphscale
 		cv2.line(graph,
@@ -358,7 +291,7 @@ def redraw_display():
 			for i,pos in zip(lineindices, lines):
 				x,y = pos
 				
-				points = np.array(map(get_keyframe, [i-1, i, i+1]))
+				points = curve[i-imin : i-imin+3]
 				
 				d2 = (points[0]+points[2])/2.0 - points[1]
 				d2 *= 100
@@ -370,7 +303,7 @@ def redraw_display():
 				thickness = 1
 				color = (0, 255, 255)
 				if graphsel_start is not None:
-					if graphsel_start <= i <= graphsel_stop:
+					if graph_selection()[0] <= i < graph_selection()[1]:
 						thickness = 3
 						color = (255,255,255)
 						spread += 3
@@ -381,6 +314,38 @@ def redraw_display():
 					color,
 					thickness=thickness, shift=8, lineType=cv2.LINE_AA)
 
+		# the final (rendered) trajectory
+		finalstart = max(0, imin)
+		finalcurve = final_trajectory.get(finalstart, imax+1)
+		if len(finalcurve) > 1:
+			cv2.polylines(
+				graph,
+				[np.int32([
+					fix8([ point[0], (imax - index) * graphscale ])
+					for index,point in enumerate(finalcurve, finalstart)
+				])],
+				False,
+				(0, 255, 0),
+				thickness=1,
+				shift=8, lineType=cv2.LINE_AA)
+
+		# what smoothing the selection would do, while it's being dragged
+		if graphsel_start is not None and graphsel_smooth:
+			(selstart, selstop) = graph_selection()
+			(selstart, selstop) = (max(selstart, imin), min(selstop, imax+1))
+			if selstart < selstop:
+				preview = smoother.smooth_range(get_trajectory, selstart, selstop)
+				cv2.polylines(
+					graph,
+					[np.int32([
+						fix8([ point[0], (imax - index) * graphscale ])
+						for index,point in zip(xrange(selstart, selstop), preview)
+					])],
+					False,
+					(255, 0, 255),
+					thickness=2,
+					shift=8, lineType=cv2.LINE_AA)
+
 		secs = src.index / framerate
 		hours, secs = divmod(secs, 3600)
 		mins, secs = divmod(secs, 60)
@@ -401,6 +366,10 @@ def onmouse_source(event, x, y, flags, userdata):
 	global mousedown, redraw
 	
 	if use_tracker:
+		if event == cv2.EVENT_LBUTTONDOWN:
+			# shift-drag adds a target, a plain drag starts over
+			global tracker_add
+			tracker_add = bool(flags & cv2.EVENT_FLAG_SHIFTKEY)
 		tracker_rectsel.onmouse(event, x, y, flags, userdata)
 		redraw = True
 		return
@@ -410,16 +379,17 @@ def onmouse_source(event, x, y, flags, userdata):
 		
 		if flags == cv2.EVENT_FLAG_LBUTTON:
 			#print "onmouse move lbutton", (x,y), flags, userdata
-			set_cursor([x,y])
+			set_cursor([x / proxyscale, y / proxyscale], drag_tag)
 
 	elif event == cv2.EVENT_LBUTTONDOWN:
 		#print "onmouse buttondown", (x,y), flags, userdata
 		mousedown = True
-		set_cursor([x,y])
+		new_drag()
+		set_cursor([x / proxyscale, y / proxyscale], drag_tag)
 
 	elif event == cv2.EVENT_LBUTTONUP:
 		#print "onmouse buttonup", (x,y), flags, userdata
-		set_cursor([x,y])
+		set_cursor([x / proxyscale, y / proxyscale], drag_tag)
 		mousedown = False
 
 def onmouse_output(event, x, y, flags, userdata):
@@ -432,12 +402,13 @@ def onmouse_graph(event, x, y, flags, userdata):
 	
 	curindex = graphbg_head - iround(y / graphscale)
 
-	global graphsel_start, graphsel_stop
+	global graphsel_start, graphsel_stop, graphsel_smooth
 
 	# implement some selection dragging (for smoothing and deleting)
 	if event in (cv2.EVENT_MBUTTONDOWN, cv2.EVENT_RBUTTONDOWN):
 		graphsel_start = curindex
 		graphsel_stop = curindex
+		graphsel_smooth = (event == cv2.EVENT_RBUTTONDOWN)
 		redraw = True
 
 	elif event == cv2.EVENT_MOUSEMOVE and flags in (cv2.EVENT_FLAG_MBUTTON, cv2.EVENT_FLAG_RBUTTON):
@@ -448,55 +419,64 @@ def onmouse_graph(event, x, y, flags, userdata):
 		graphsel_stop = curindex
 		redraw = True
 
-		indices = range(graphsel_start, graphsel_stop+1)
-
-		# prepare to undo this
-		oldkeyframes = {i: keyframes[i] for i in indices if keyframes[i] is not None}
-		def undo():
-			for i in indices: keyframes[i] = None
-			for i in oldkeyframes:
-				keyframes[i] = oldkeyframes[i]
-		undoqueue.append(undo)
-		while len(undoqueue) > 100:
-			undoqueue.pop(0)
+		(start, stop) = graph_selection()
 
 		graphsel_start = None
 
 		### graph smoothing
-		if event is cv2.EVENT_RBUTTONUP:
-			updates = { i: smoothed_keyframe(i) for i in indices }
-			for i in indices: keyframes[i] = updates[i]
+		if event is cv2.EVENT_RBUTTONUP and start < stop:
+			updates = smoother.smooth_range(get_trajectory, start, stop)
+			with history.change(start, stop, "smooth {0}..{1}".format(start, stop-1)):
+				keyframes.set_range(start, updates)
 
 		### graph smoothing
 		if event is cv2.EVENT_MBUTTONUP:
-			for i in indices: keyframes[i] = None
+			with history.change(start, stop, "clear {0}..{1}".format(start, stop-1)):
+				keyframes.clear_range(start, stop)
 
 	if graphdraw:
 		if (event == cv2.EVENT_LBUTTONDOWN) or (event == cv2.EVENT_MOUSEMOVE and flags == cv2.EVENT_FLAG_LBUTTON):
+			if event == cv2.EVENT_LBUTTONDOWN:
+				new_drag()
 			(ax,ay) = get_keyframe(curindex)
 			ax = x
-			keyframes[curindex] = np.float32([ax, ay])
+			set_keyframe(curindex, np.float32([ax, ay]), drag_tag)
 			redraw = True
 
 	else:
 		if (event == cv2.EVENT_LBUTTONDOWN):
 			load_this_frame(curindex)
 
-smoothing_radius = 2
-smoothing_kernel = range(-smoothing_radius, +smoothing_radius+1)
+def graph_selection():
+	"selected frames [start, stop) in the graph, either drag direction"
+	(start, stop) = sorted((graphsel_start, graphsel_stop))
+	return (max(0, start), min(totalframes, stop+1))
 
 def smoothed_keyframe(i):
-	#import pdb; pdb.set_trace()
-	return np.sum([get_keyframe(i+j) for j in smoothing_kernel], axis=0, dtype=np.float32) / len(smoothing_kernel)
+	return smoother.smooth_range(get_trajectory, i, i+1)[0]
 	
-def set_cursor(newanchor):
+def set_cursor(newanchor, tag=None):
 	global anchor, redraw
 	if not isinstance(newanchor, np.float32):
 		newanchor = np.float32(newanchor)
-	keyframes[src.index] = anchor = newanchor
+	set_keyframe(src.index, newanchor, tag)
+	anchor = newanchor
 	redraw = True
 	#print "set cursor", anchor
 
+def set_keyframe(index, value, tag=None):
+	"an undoable keyframe write. writes with the same tag (a drag) undo together"
+	with history.change(index, index+1, "keyframe {0}".format(index), tag):
+		keyframes[index] = value
+
+def new_drag():
+	global drag_tag
+	drag_tag = ('drag', drag_tag[1] + 1)
+
+def new_tracking():
+	global tracker_tag
+	tracker_tag = ('tracker', tracker_tag[1] + 1)
+
 def save(do_query=False):
 	# meta file
 	output = json.dumps(meta, indent=2, sort_keys=True)
@@ -520,51 +500,33 @@ def save(do_query=False):
 		open(metafile, "w").write(output)
 		print "wrote metafile"
 	
-	# keyframes
-	output = json.dumps(
-		[None if (x is None) else x.tolist() for x in keyframes],
-		indent=2,
-		sort_keys=True)
-	
-	do_write = True
-	exists = os.path.exists(meta['keyframes'])
-	
-	if exists:
-		do_write &= (open(meta['keyframes']).read() != output)
-		
-	if do_query and do_write:
-		do_write &= (raw_input("write keyframes? (y/n) ").lower().startswith('y'))
+	# keyframes: every edit is already in the journal, this folds it into
+	# the snapshot (in the background)
+	journal.compact()
+	print "keyframes saved"
+
+	if do_query:
+		export_keyframes()
+
+def export_keyframes():
+	"JSON copy of the keyframes, if they changed since it was read or written"
+	global exported_version
+	if keyframes.version == exported_version:
+		return
 
-	if do_write:
-		if exists:
-			bakfile = "{0}.bak".format(meta['keyframes'])
-			if os.path.exists(bakfile):
-				os.unlink(bakfile)
-			os.rename(meta['keyframes'], bakfile)
-
-		open(meta['keyframes'], "w").write(output)
-		print "wrote keyframes"
-
-def scan_nonempty(keyframes, pos, step):
-	if step < 0:
-		while pos >= 0 and step < 0:
-			if keyframes[pos] is not None:
-				return pos
-			pos -= 1
-			step += 1
-		else:
-			return None
-
-	elif step > 0:
-		while pos < len(keyframes) and step > 0:
-			if keyframes[pos] is not None:
-				return pos
-			pos += 1
-			step -= 1
-		else:
-			return None
-	
-	return None
+	if not raw_input("write keyframes? (y/n) ").lower().startswith('y'):
+		return
+
+	output = json.dumps(keyframes.to_list(), indent=2, sort_keys=True)
+	if os.path.exists(meta['keyframes']):
+		bakfile = "{0}.bak".format(meta['keyframes'])
+		if os.path.exists(bakfile):
+			os.unlink(bakfile)
+		os.rename(meta['keyframes'], bakfile)
+
+	open(meta['keyframes'], "w").write(output)
+	exported_version = keyframes.version
+	print "wrote keyframes"
 
 def get_keyframe(index):
 	if not (0 <= index < totalframes):
@@ -573,33 +535,39 @@ def get_keyframe(index):
 	if keyframes[index] is not None:
 		return np.float32(keyframes[index])
 
-	else:
-		prev = scan_nonempty(keyframes, index-1, -100)
-		next = scan_nonempty(keyframes, index+1, +100)
-		
-		if prev is None and next is None:
-			return np.float32(meta['anchor'])
-		
-		if prev is None:
-			return np.float32(keyframes[next])
-		
-		if next is None:
-			return np.float32(keyframes[prev])
-		
-		alpha = (index - prev) / (next-prev)
-		#print "alpha", alpha, index, prev, next
-		u = np.array(keyframes[prev])
-		v = np.array(keyframes[next])
-		return np.float32(0.5 + u + alpha * (v-u))
+	return get_trajectory(index, index+1)[0]
+
+def get_trajectory(start=0, stop=None):
+	"anchor positions for frames [start, stop), see trajectory.interpolate"
+	if stop is None:
+		stop = totalframes
+
+	# only keyframes that can reach into the range
+	lo = max(0, start - trajectory.hold)
+	hi = min(totalframes, stop + trajectory.hold)
+	(keys, values) = keyframes.keys_in(lo, hi)
+
+	return trajectory.interpolate(keys, values, start, stop, totalframes, meta['anchor'])
 
 def on_tracker_rect(rect):
 	print "rect selected:", rect
-	init_tracker(rect)
+	init_tracker(np.float32(rect) / proxyscale, add=tracker_add)
+
+def init_tracker(rect, add=False):
+	"a tracker on rect, or another target for it (add), that keeps its offset to the anchor"
+	global tracker, tracker_offsets
 
-def init_tracker(rect):
-	global tracker
-	tracker = MOSSE(curframe_gray, tracker_downscale(rect))
-	set_cursor(tracker_upscale(tracker.pos))
+	if add and tracker:
+		target = tracker.add(curframe_gray, tracker_downscale(rect), tracker_warps, tracker_seed)
+		tracker_offsets = np.float32(np.vstack([tracker_offsets, anchor - tracker_upscale(target.pos)]))
+		print "tracker target added, {0} targets".format(len(tracker))
+		return
+
+	tracker = MOSSEGroup()
+	target = tracker.add(curframe_gray, tracker_downscale(rect), tracker_warps, tracker_seed)
+	tracker_offsets = np.zeros((1, 2), np.float32)
+	new_tracking()
+	set_cursor(tracker_upscale(target.pos), tracker_tag)
 	print "tracked initialized"
 	
 def load_delta_frame(tdelta):
@@ -614,10 +582,12 @@ def load_delta_frame(tdelta):
 			newanchor = oldanchor.copy()
 
 			if tracker:
-				xydelta = tracker.track(curframe_gray, pos=(oldanchor * trackerscale)) / trackerscale
+				# every target searches around the old anchor, at its offset
+				positions = oldanchor - tracker_offsets
+				xydeltas = tracker.track(curframe_gray, positions * trackerscale) / trackerscale
 
-				if tracker.good:
-					newanchor += xydelta
+				if tracker.good: # follow the best scoring target
+					newanchor += xydeltas[tracker.best]
 				else:
 					result = True # stop
 					print "tracking bad, aborting"
@@ -626,7 +596,7 @@ def load_delta_frame(tdelta):
 				global faces_roi # will be set
 
 				if tracker:
-					trackersize = np.float32(tracker.size) / trackerscale # from tracker scale to source scale
+					trackersize = np.float32(tracker.targets[tracker.best].size) / trackerscale # from tracker scale to source scale
 					faces_roi = np.hstack([
 						newanchor + trackersize * faces_rel_roi[0:2],
 						newanchor + trackersize * faces_rel_roi[2:4]
@@ -652,16 +622,21 @@ def load_delta_frame(tdelta):
 					redraw = True
 
 			if tracker and tracker.good:
-				# use (dx,dy) from above, possibly updated by face pos
+				# use (dx,dy) from above, possibly updated by face pos.
+				# the other good targets adapt where they found themselves,
+				# and their offsets follow the anchor
+				which = np.array([target.good for target in tracker.targets])
+				positions += xydeltas
+				positions[tracker.best] = newanchor - tracker_offsets[tracker.best]
+				tracker_offsets[which] = newanchor - positions[which]
 
-				tracker.adapt(curframe_gray, rate=tracker_adapt_rate, pos=(newanchor * trackerscale))
+				tracker.adapt(curframe_gray, positions * trackerscale, rate=tracker_adapt_rate, which=which)
 
-				set_cursor(newanchor)
+				set_cursor(newanchor, tracker_tag)
 
 				# update xt
 				if draw_graph:
-					graphbg[graphbg_head - src.index] = \
-						src.cache[src.index][ np.clip(newanchor[1], 0, srch-1) ]
+					graphbg[graphbg_head - src.index] = graph_row(src.index, curframe)
 
 	else: # big jump
 		load_this_frame(src.index + tdelta, bool(tracker))
@@ -672,7 +647,7 @@ def load_delta_frame(tdelta):
 	if (tdelta > 0) and (graphbg_head is not None) and (draw_graph):
 		imax = graphbg_head
 		imin = imax - graphslices//2
-		src.cache_range(imin, imax)
+		cache_stripes(imin, imax, background=True)
 	
 	return result
 
@@ -695,23 +670,26 @@ def load_this_frame(index=None, update_tracker=True, only_decode=False):
 		return
 
 	if not only_decode:
-		curframe_gray = cv2.resize(
-			cv2.cvtColor(curframe, cv2.COLOR_BGR2GRAY),
-			dsize=None,
-			fx=trackerscale, fy=trackerscale,
-			interpolation=cv2.INTER_AREA)
+		curframe_gray = None
+		if (graysrc is not None) and (use_tracker or use_faces): # otherwise it's not decoding
+			curframe_gray = graysrc.get(src.index)
+		if curframe_gray is None:
+			curframe_gray = src.plane(src.index, 'tracker_gray', tracker_gray)
+		if curframe_gray is None: # already evicted
+			curframe_gray = tracker_gray(curframe)
 		
 	anchor = get_keyframe(src.index)
 	
 	#print "frame", src.index, "anchor {0:8.3f} x {1:8.3f}".format(*anchor)
 
 	if update_tracker and tracker and not only_decode:
-		print "set tracker to", tracker.pos
-		tracker.pos = tracker_downscale(anchor)
+		print "set tracker to", anchor
+		for (target, offset) in zip(tracker.targets, tracker_offsets):
+			target.pos = np.float32(tracker_downscale(anchor - offset))
 
 	if abs(delta) > 1 and use_tracker and tracker and (tracker_rectsel.drag_radius is not None):
 		(tx,ty) = anchor
-		(rx, ry) = tracker_rectsel.drag_radius
+		(rx, ry) = np.float32(tracker_rectsel.drag_radius) / proxyscale
 		if rx > 0 and ry > 0:
 			print "resetting tracker"
 			newrect = (tx-rx, ty-ry, tx+rx, ty+ry)
@@ -719,102 +697,548 @@ def load_this_frame(index=None, update_tracker=True, only_decode=False):
 
 	redraw = True
 
+def tracker_gray(frame):
+	return cv2.resize(
+		cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY),
+		dsize=None,
+		fx=trackerscale/proxyscale, fy=trackerscale/proxyscale,
+		interpolation=cv2.INTER_AREA)
+
 def tracker_upscale(point):
 	return tuple(v / trackerscale for v in point)
 
 def tracker_downscale(point):
 	return tuple(v * trackerscale for v in point)
 
-def dump_video(videodest):
-	output = np.zeros((totalframes, 2), dtype=np.float32)
-
-	prevgood = None
-	nextgood = None
-	for i in xrange(totalframes):
-		output[i] = get_keyframe(i)
-
-	(xmin, xmax) = meta['anchor_x_range']
-	(ymin, ymax) = meta['anchor_y_range']
-	
-	output[output[:,0] < xmin, 0] = xmin
-	output[output[:,0] > xmax, 0] = xmax
-	output[output[:,1] < ymin, 1] = ymin
-	output[output[:,1] > ymax, 1] = ymax
-	
-	sigma = meta.get('sigma', 0)
-	
-	if sigma > 0:
-		sigma *= framerate
-		output[:,0] = scipy.ndimage.filters.gaussian_filter(output[:,0], sigma)
-		output[:,1] = scipy.ndimage.filters.gaussian_filter(output[:,1], sigma)
+def open_video(fname):
+	"cv2.VideoCapture, or FFReader with meta 'reader': 'ffmpeg' (threaded decode)"
+	if meta.get('reader', 'opencv') == 'ffmpeg':
+		return FFReader(fname, threads=int(meta.get('reader_threads', 0)))
+	return cv2.VideoCapture(fname)
+
+def video_size(fname):
+	vid = cv2.VideoCapture(fname)
+	size = (int(vid.get(cv2.CAP_PROP_FRAME_WIDTH)), int(vid.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+	vid.release()
+	return size
+
+def make_proxy(source, proxyfile=None, scale=0.5):
+	"downscaled all-intra copy of the source, made once and remade when the source is newer or the scale changed"
+	if proxyfile is None:
+		proxyfile = "{0}.proxy{1:g}.mp4".format(os.path.splitext(source)[0], scale)
+
+	if os.path.exists(proxyfile) and os.path.getmtime(proxyfile) >= os.path.getmtime(source):
+		# as ffmpeg's scale filter below
+		(srcw, srch) = video_size(source)
+		if video_size(proxyfile) == (int(srcw * scale / 2) * 2, int(srch * scale / 2) * 2):
+			return proxyfile
+		print "proxy {0} has a different scale".format(proxyfile)
+
+	print "making proxy {0} at scale {1}...".format(proxyfile, scale)
+	tmpfile = "{0}.tmp{1}".format(*os.path.splitext(proxyfile))
+	subprocess.check_call([
+		'ffmpeg',
+		'-loglevel', 'warning',
+		'-i', source,
+		'-an',
+		'-vsync', 'passthrough', # same frames as the source
+		'-vf', 'scale=trunc(iw*{0}/2)*2:trunc(ih*{0}/2)*2'.format(scale),
+		'-c:v', 'libx264',
+		'-g', '1', # every frame is a key frame: cheap seeks
+		'-crf', '18',
+		'-preset', 'veryfast',
+		'-tune', 'fastdecode',
+		'-y', tmpfile
+	])
+	if os.path.exists(proxyfile):
+		os.unlink(proxyfile)
+	os.rename(tmpfile, proxyfile)
+	return proxyfile
+
+def dump_video(videodest, jobs=1, graph=False):
+	output = final_trajectory.get()
+
+	if graph:
+		return dump_ffmpeg_graph(videodest, output)
+
+	if jobs > 1:
+		return dump_parallel(videodest, output, jobs)
+
+	# pipeline: decode thread -> warp pool -> encode (this thread).
+	# 'pending' holds the warp results in frame order, its size bounds
+	# the frames in flight.
+	workers = int(meta.get('render_threads', 2))
+	pool = ThreadPool(workers)
+	pending = Queue.Queue(maxsize=int(meta.get('render_queue', 8)))
+	stop = threading.Event()
+	busy = { 'decode': 0.0, 'warp': 0.0, 'encode': 0.0 }
+	failed = []
+
+	def warp(frame, k):
+		t0 = time.time()
+		surface = render_frame(frame, k, yuv=render_yuv)
+		return (surface, time.time() - t0)
+
+	def decode():
+		try:
+			for i,k in enumerate(output):
+				if stop.is_set(): break
+				t0 = time.time()
+				frame = src.get(i)
+				busy['decode'] += time.time() - t0
+				if frame is None: break
+				pending.put(pool.apply_async(warp, (frame, k)))
+		except Exception as e:
+			failed.append(e)
+		finally:
+			pending.put(None)
+
+	decoder = threading.Thread(target=decode, name="decode")
+	decoder.start()
+	tstart = time.time()
 
 	do_pieces = ('%' in videodest)
 	outseq = 1
 	outvid = None
+	outfiles = []
+	writerstats = []
+	i = 0
+	nextreport = tstart
+
+	def interrupt(signum, stackframe):
+		# drop the frames in flight and close the writer, so ffmpeg
+		# finalises the file. a second signal doesn't wait.
+		if stop.is_set():
+			raise KeyboardInterrupt
+		stop.set()
+
+	handlers = dict((signum, signal.signal(signum, interrupt)) for signum in (signal.SIGINT, signal.SIGTERM))
+
+	try:
+		while True:
+			result = pending.get()
+			if result is None: break
+			(surface, dt) = result.get()
+			busy['warp'] += dt
+			if stop.is_set(): continue # draining
+
+			if do_pieces and (i % int(600 * framerate) == 0) and (outvid is not None):
+				outvid.release()
+				writerstats.append(outvid.stats())
+				outvid = None
+				outseq += 1
+
+			if outvid is None:
+				outfiles.append(videodest % outseq if do_pieces else videodest)
+				outvid = open_writer(outfiles[-1])
+
+			t0 = time.time()
+			outvid.write(surface)
+			busy['encode'] += time.time() - t0
+
+			i += 1
+
+			now = time.time()
+			if now >= nextreport:
+				nextreport = now + progress_interval
+				fps = i / max(now - tstart, 1e-6)
+				report('progress',
+					frame=i, frames=totalframes, fps=round(fps, 2),
+					eta=round((totalframes - i) / fps, 1),
+					bytes=files_size(outfiles))
 
-	for i,k in enumerate(output):
-		if do_pieces and (i % int(600 * framerate) == 0) and (outvid is not None):
+	finally:
+		for signum, handler in handlers.items():
+			signal.signal(signum, handler)
+		# let the decoder finish, it may be blocked on a full queue
+		stop.set()
+		while decoder.is_alive():
+			try:
+				pending.get(timeout=0.1)
+			except Queue.Empty:
+				pass
+		decoder.join()
+		pool.close()
+		pool.join()
+		if outvid is not None:
 			outvid.release()
-			outvid = None
-			outseq += 1
+			writerstats.append(outvid.stats())
+
+	if failed:
+		raise failed[0]
+
+	wall = time.time() - tstart
+	busy['warp'] /= workers
+	report('done',
+		frame=i, frames=totalframes, seconds=round(wall, 2),
+		fps=round(i / wall, 2), bytes=files_size(outfiles),
+		interrupted=(i < totalframes),
+		busy=dict((stage, round(100 * busy[stage] / wall, 1)) for stage in busy),
+		stage_seconds=dict((stage, round(busy[stage], 2)) for stage in busy),
+		writer={
+			'stall': round(sum(ws['stall'] for ws in writerstats), 2),
+			'write': round(sum(ws['write'] for ws in writerstats), 2),
+			'queue_max': max([ws['queue_max'] for ws in writerstats] or [0]),
+		})
+
+def report(event, **fields):
+	"progress for whatever drives the render: one JSON object per line on stdout"
+	fields['event'] = event
+	reportout.write(json.dumps(fields, sort_keys=True) + "\n")
+	reportout.flush()
+
+def files_size(fnames):
+	return sum(os.path.getsize(fname) for fname in fnames if os.path.exists(fname))
+
+def open_writer(fname):
+	return ffwriter.FFWriter(
+		fname,
+		framerate, (screenw, screenh),
+		codec='libx264', pixfmt='yuv420p' if render_yuv else 'bgr24',
+		moreflags='-loglevel 32 -pix_fmt yuv420p -crf 15 -preset ultrafast',
+		# encoder stalls don't reach the render pipeline until this fills up
+		queuesize=int(meta.get('writer_queue', 8)),
+		pipesize=2**20)
+
+def split_segments(count, parts, gops=None):
+	"[start, stop) ranges covering count frames, cut at key frames if there is a GOP index"
+	cuts = set([0])
+	for n in xrange(1, parts):
+		cut = n * count // parts
+		if gops:
+			cut = gops[max(0, bisect.bisect_right(gops, cut) - 1)]
+		cuts.add(cut)
+	cuts = sorted(cuts) + [count]
+	return zip(cuts[:-1], cuts[1:])
+
+def dump_parallel(videodest, output, jobs):
+	"""renders segments of the timeline in worker processes, then joins them.
+
+	with '%' in videodest the 600 s pieces are the segments, otherwise the
+	timeline is cut into GOP-aligned segments that are concatenated
+	without re-encoding.
+	"""
+	do_pieces = ('%' in videodest)
+	if do_pieces:
+		piece = int(600 * framerate)
+		segments = [(i, min(i + piece, totalframes)) for i in xrange(0, totalframes, piece)]
+		destinations = [videodest % (n+1) for n in xrange(len(segments))]
+	else:
+		segments = split_segments(totalframes, jobs, src.gops)
+		(base, ext) = os.path.splitext(videodest)
+		destinations = ["{0}.part{1:03d}{2}".format(base, n, ext) for n in xrange(len(segments))]
+
+	# everything a worker needs, it can't rely on this process' globals
+	tasks = [
+		{
+			'meta': meta,
+			'fps': framerate,
+			'framecount': totalframes,
+			'gops': src.gops,
+			'render_subpixel': render_subpixel,
+			'render_yuv': render_yuv,
+			'start': start,
+			'stop': stop,
+			'trajectory': output[start:stop],
+			'dest': dest,
+		}
+		for (start, stop), dest in zip(segments, destinations)
+	]
+
+	print "rendering {0} segments with {1} processes".format(len(tasks), jobs)
+	tstart = time.time()
+	# workers ignore Ctrl-C, on a signal they finish the frame and close the
+	# writer, so their ffmpeg finalises the file. a second signal doesn't wait.
+	stop = multiprocessing.Event()
+	pool = multiprocessing.Pool(min(jobs, len(tasks)), init_render_worker, (stop,))
+
+	def interrupt(signum, stackframe):
+		if stop.is_set():
+			raise KeyboardInterrupt
+		stop.set()
+
+	handlers = dict((signum, signal.signal(signum, interrupt)) for signum in (signal.SIGINT, signal.SIGTERM))
+	written = {}
+	try:
+		results = pool.imap_unordered(render_segment, tasks)
+		done = 0
+		for n in xrange(len(tasks)):
+			# a timeout keeps the wait interruptible
+			(dest, count, secs) = results.next(timeout=1e6)
+			done += count
+			written[dest] = count
+			fps = done / (time.time() - tstart)
+			report('progress',
+				frame=done, frames=totalframes, fps=round(fps, 2),
+				eta=round((totalframes - done) / fps, 1) if fps > 0 else None,
+				bytes=files_size(written), segment=dest)
+		pool.close()
+	except:
+		pool.terminate()
+		raise
+	finally:
+		pool.join()
+		for signum, handler in handlers.items():
+			signal.signal(signum, handler)
+
+	# interrupted, the output is the segments up to the first one that's
+	# incomplete. otherwise only the source's end can cut one short.
+	complete = []
+	frames = 0
+	for (start, end), dest in zip(segments, destinations):
+		count = written.get(dest, 0)
+		if count > 0:
+			complete.append(dest)
+			frames += count
+		if stop.is_set() and count < end - start: break
+
+	if do_pieces:
+		outfiles = complete if stop.is_set() else destinations
+		for dest in destinations:
+			if dest not in outfiles and os.path.exists(dest):
+				os.unlink(dest)
+	else:
+		outfiles = [videodest]
+		if complete:
+			concat_videos(complete, videodest)
+		for dest in destinations:
+			if os.path.exists(dest):
+				os.unlink(dest)
+
+	wall = time.time() - tstart
+	report('done',
+		frame=frames, frames=totalframes, seconds=round(wall, 2),
+		fps=round(frames / wall, 2), bytes=files_size(outfiles),
+		interrupted=stop.is_set(), jobs=jobs)
+
+def dump_ffmpeg_graph(videodest, output):
+	"""renders in a single ffmpeg process: the trajectory becomes crop
+	positions sent per frame (sendcmd), followed by a scale. no frames pass
+	through python. positions are rounded to whole source pixels.
+	"""
+	assert '%' not in videodest, "pieces need the python render path"
 
-		if outvid is None:
-			if i == 0:
-				fourcc = -1 # user config
-			else:
-				fourcc = cv2.VideoWriter_fourcc(*"X264")
-				
-			outvid = ffwriter.FFWriter(
-				videodest,
-				framerate, (screenw, screenh),
-				codec='libx264', pixfmt='bgr24',
-				moreflags='-loglevel 32 -pix_fmt yuv420p -crf 15 -preset ultrafast')
-			#outvid = cv2.VideoWriter(videodest % outseq, fourcc, framerate, (screenw, screenh))
-			#assert outvid.isOpened()
-
-		load_this_frame(i, only_decode=True)
-
-		# anchor is animated
-		(ax,ay) = k
-
-		Anchor = np.matrix([
-			[1, 0, -ax],
-			[0, 1, -ay],
-			[0, 0, 1.0],
-		])
-		InvAnchor = np.linalg.inv(Anchor)
-		scale = meta['scale']
-		Scale = np.matrix([
-			[scale, 0, 0],
-			[0, scale, 0],
-			[0, 0, 1.0]
+	scale = meta['scale']
+	(cropw, croph) = (iround(screenw / scale), iround(screenh / scale))
+
+	# source rectangle of each output frame
+	x0 = np.round(output[:,0] - position[0] / scale).astype(int)
+	y0 = np.round(output[:,1] - position[1] / scale).astype(int)
+
+	# pad the source so every crop is inside, black as in the python path.
+	# even margins, for 4:2:0 sources
+	even = lambda v: int(v + (v & 1))
+	(left, top) = (even(max(0, -x0.min())), even(max(0, -y0.min())))
+	right = even(max(0, (x0 + cropw).max() - srcw))
+	bottom = even(max(0, (y0 + croph).max() - srch))
+	x0 += left
+	y0 += top
+
+	cmdfile = videodest + '.cmds'
+	with open(cmdfile, 'w') as fh:
+		(lastx, lasty) = (None, None)
+		for i in xrange(len(output)):
+			if (x0[i], y0[i]) == (lastx, lasty): continue
+			# halfway to the frame, after the previous one
+			t = max(0, (i - 0.5) / framerate)
+			fh.write("{0:.6f} crop x {1}, crop y {2};\n".format(t, x0[i], y0[i]))
+			(lastx, lasty) = (x0[i], y0[i])
+
+	filters = [
+		'setpts=PTS-STARTPTS',
+		'fps={0!r}'.format(framerate),
+		'pad={0}:{1}:{2}:{3}'.format(srcw + left + right, srch + top + bottom, left, top),
+		"sendcmd=f='{0}'".format(cmdfile.replace('\\', '/')),
+		# exact: no rounding of x/y to the chroma grid
+		'crop={0}:{1}:{2}:{3}:exact=1'.format(cropw, croph, x0[0], y0[0]),
+		'scale={0}:{1}:flags=bilinear'.format(screenw, screenh),
+	]
+
+	proc = subprocess.Popen([
+		'ffmpeg',
+		'-nostdin',
+		'-loglevel', 'warning',
+		'-nostats',
+		'-progress', 'pipe:1',
+		'-threads', '0',
+		'-i', meta['source'],
+		'-an',
+		'-vf', ','.join(filters),
+		'-frames:v', str(len(output)),
+		'-c:v', 'libx264',
+		'-pix_fmt', 'yuv420p',
+		'-crf', '15',
+		'-preset', 'ultrafast',
+		'-y', videodest
+	], stdout=subprocess.PIPE,
+		# as FFWriter: signals are ours, passed on so ffmpeg finishes the file
+		preexec_fn=os.setpgrp if os.name == 'posix' else None,
+		creationflags=getattr(subprocess, 'CREATE_NEW_PROCESS_GROUP', 0))
+
+	interrupted = [False]
+	def interrupt(signum, stackframe):
+		interrupted[0] = True
+		proc.send_signal(signal.SIGINT if os.name == 'posix' else signal.SIGTERM)
+
+	handlers = dict((signum, signal.signal(signum, interrupt)) for signum in (signal.SIGINT, signal.SIGTERM))
+
+	tstart = time.time()
+	frame = 0
+	try:
+		# -progress: blocks of key=value lines, each ending with progress=...
+		values = {}
+		for line in iter(proc.stdout.readline, ''):
+			(key, _, value) = line.strip().partition('=')
+			values[key] = value
+			if key != 'progress': continue
+			frame = int(values.get('frame', 0))
+			fps = frame / max(time.time() - tstart, 1e-6)
+			report('progress',
+				frame=frame, frames=totalframes, fps=round(fps, 2),
+				eta=round((totalframes - frame) / fps, 1) if fps > 0 else None,
+				bytes=int(values.get('total_size', 0) or 0))
+		rv = proc.wait()
+	finally:
+		for signum, handler in handlers.items():
+			signal.signal(signum, handler)
+		os.unlink(cmdfile)
+
+	# stopped by us, ffmpeg exits non-zero but has finished the file
+	if rv != 0 and not (interrupted[0] and frame > 0):
+		raise IOError("ffmpeg exited with code {0}".format(rv))
+
+	wall = time.time() - tstart
+	report('done',
+		frame=frame, frames=totalframes, seconds=round(wall, 2),
+		fps=round(frame / wall, 2), bytes=files_size([videodest]),
+		interrupted=interrupted[0], graph=True)
+
+render_stop = None # set by dump_parallel's signal handler, seen by the workers
+
+def init_render_worker(stop):
+	"pool initializer: Ctrl-C is the parent's, it stops workers through 'stop'"
+	global render_stop
+	# SIGTERM stays fatal, pool.terminate() on a second signal relies on it
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	render_stop = stop
+
+def render_segment(task):
+	"""worker process: renders trajectory frames [start, stop) into their own
+	file. returns (file, frames written, seconds), no file if stopped before"""
+	if render_stop.is_set():
+		return (task['dest'], 0, 0.0)
+
+	global meta, position, screenw, screenh, framerate, render_subpixel, render_yuv
+	meta = task['meta']
+	position = np.float32(meta['position'])
+	(screenw, screenh) = meta['screen']
+	framerate = task['fps']
+	render_subpixel = task['render_subpixel']
+	render_yuv = task['render_yuv']
+
+	t0 = time.time()
+	vid = RateChangedVideo(open_video(meta['source']), fps=framerate)
+	(width, height) = (vid.vid.get(cv2.CAP_PROP_FRAME_WIDTH), vid.vid.get(cv2.CAP_PROP_FRAME_HEIGHT))
+	source = CachingVideoReader(
+		vid, task['framecount'],
+		cachebytes=int(10 * width * height * 3),
+		gops=task['gops'])
+
+	outvid = open_writer(task['dest'])
+	count = 0
+	try:
+		for i,k in zip(xrange(task['start'], task['stop']), task['trajectory']):
+			if render_stop.is_set(): break
+			frame = source.get(i)
+			if frame is None: break
+			outvid.write(render_frame(frame, k, yuv=render_yuv))
+			count += 1
+	finally:
+		outvid.release()
+		source.close()
+
+	return (task['dest'], count, time.time() - t0)
+
+def concat_videos(parts, videodest):
+	"joins same-format videos with ffmpeg's concat demuxer, streams are copied"
+	listfile = videodest + '.concat.txt'
+	with open(listfile, 'w') as fh:
+		for part in parts:
+			# concat list syntax: single quotes, escaped as '\''
+			fh.write("file '{0}'\n".format(os.path.abspath(part).replace("'", "'\\''")))
+	try:
+		subprocess.check_call([
+			'ffmpeg',
+			'-loglevel', 'warning',
+			'-f', 'concat',
+			'-safe', '0',
+			'-i', listfile,
+			'-c', 'copy',
+			'-y', videodest
 		])
+	finally:
+		os.unlink(listfile)
 
-		# position is fixed in meta
-		Translate = np.matrix([
-			[1, 0, position[0]],
-			[0, 1, position[1]],
-			[0, 0, 1.0]
-		])
+def transform_matrix((ax, ay)):
+	"2x3 source -> output transform, placing anchor (ax, ay) at 'position'"
+	scale = meta['scale']
+	return np.float64([
+		[scale, 0, position[0] - scale * ax],
+		[0, scale, position[1] - scale * ay],
+	])
 
-		M = Translate * Scale * Anchor
-		InvM = np.linalg.inv(M)
+def render_frame(frame, anchor, yuv=False):
+	"output surface for a source frame, as planar yuv420p for the encoder if yuv"
+	surface = warp_crop(frame, transform_matrix(anchor), (screenw, screenh), subpixel=render_subpixel)
+	if yuv:
+		# half the bytes of bgr24 through the pipe, converted in the render worker
+		surface = cv2.cvtColor(surface, cv2.COLOR_BGR2YUV_I420)
+	return surface
+
+def warp_crop(frame, M, (width, height), interpolation=cv2.INTER_LINEAR, subpixel=True):
+	"""cv2.warpAffine(frame, M, (width, height)), touching only the source region
+	for axis-aligned M. without subpixel, that region is cropped at whole pixels
+	and resized once, otherwise the crop is warped with M shifted to match."""
+	(sx, sy) = (M[0,0], M[1,1])
+	if M[0,1] != 0 or M[1,0] != 0 or sx <= 0 or sy <= 0:
+		return cv2.warpAffine(frame, M, (width, height), flags=interpolation)
+
+	# source position of output pixel (0,0) and the region's size
+	(x0, y0) = (-M[0,2] / sx, -M[1,2] / sy)
+	(w, h) = (width / sx, height / sy)
+
+	if subpixel:
+		# a pixel of margin for interpolation
+		(ix0, iy0) = (int(np.floor(x0)) - 1, int(np.floor(y0)) - 1)
+		(ix1, iy1) = (int(np.ceil(x0 + w)) + 2, int(np.ceil(y0 + h)) + 2)
+	else:
+		# cv2.resize samples at pixel centers: (u + 0.5) / scale - 0.5
+		(ix0, iy0) = (iround(x0 - 0.5/sx + 0.5), iround(y0 - 0.5/sy + 0.5))
+		(ix1, iy1) = (ix0 + iround(w), iy0 + iround(h))
 
-		#surface = cv2.warpAffine(curframe, M[0:2,:], (screenw, screenh), flags=cv2.INTER_CUBIC)
-		surface = cv2.warpAffine(curframe, M[0:2,:], (screenw, screenh), flags=cv2.INTER_LINEAR)
-		
-		outvid.write(surface)
+	roi = crop_padded(frame, ix0, iy0, ix1, iy1)
 
-		if i % 10 == 0:
-			#sys.stdout.write("\rframe {0} of {1} written ({2:.3f}%)".format(i, totalframes, 100.0 * i/totalframes))
-			sys.stdout.flush()
-			cv2.imshow("rendered", cv2.pyrDown(surface))
-			key = cv2.waitKey(1)
-			if key == 27: break
+	if subpixel:
+		Mroi = M.copy()
+		Mroi[0,2] += sx * ix0
+		Mroi[1,2] += sy * iy0
+		return cv2.warpAffine(roi, Mroi, (width, height), flags=interpolation)
+
+	return cv2.resize(roi, (width, height), interpolation=interpolation)
 
-	cv2.destroyWindow("rendered")
-	outvid.release()
-	print "done"
+def crop_padded(frame, x0, y0, x1, y1):
+	"frame[y0:y1, x0:x1], black where that is outside the frame"
+	(fh, fw) = frame.shape[:2]
+	(cx0, cy0) = (np.clip(x0, 0, fw), np.clip(y0, 0, fh))
+	(cx1, cy1) = (np.clip(x1, 0, fw), np.clip(y1, 0, fh))
+
+	if (cx0, cy0, cx1, cy1) == (x0, y0, x1, y1):
+		return frame[y0:y1, x0:x1]
+
+	roi = np.zeros((y1-y0, x1-x0) + frame.shape[2:], dtype=frame.dtype)
+	if cx0 < cx1 and cy0 < cy1:
+		roi[cy0-y0:cy1-y0, cx0-x0:cx1-x0] = frame[cy0:cy1, cx0:cx1]
+	return roi
 
 def detect_faces(subrect=None):
 	# http://docs.opencv.org/modules/objdetect/doc/cascade_classification.html#cascadeclassifier-detectmultiscale
@@ -860,6 +1284,10 @@ draw_output = True
 draw_graph = True
 draw_tracker = True
 dispscale = 0.5
+proxyscale = 1.0 # editing frames / source frames
+render_subpixel = True # renders keep fractional anchor positions
+render_yuv = True # renders go to the encoder as yuv420p, not bgr24
+progress_interval = 1.0 # seconds between dump progress reports
 
 graphbg = None
 graphbg_head = None
@@ -869,6 +1297,9 @@ graphdraw = False
 
 graphsel_start = None
 graphsel_stop = None
+graphsel_smooth = False # right button: smoothing, middle: clearing
+
+smoother = Smoother() # range smoothing in the graph, meta 'smoothing'
 
 graphslices = 125
 graphscale = 6 # pixels per frame
@@ -876,11 +1307,16 @@ graphscale = 6 # pixels per frame
 
 graphheight = iround(graphslices * graphscale)
 
-tracker = None
+tracker = None # MOSSEGroup
+tracker_offsets = None # anchor minus each target's position, source scale
+tracker_add = False # the rect being drawn adds a target
 use_tracker = False
 trackerscale = 0.5
 tracker_adapt_rate = 0.2
+tracker_warps = 128 # random warps a new target trains on
+tracker_seed = None # fixed: the same rect trains the same filter
 tracker_rectsel = RectSelector(on_tracker_rect)
+graysrc = None # tracker-scale gray frames straight from ffmpeg, meta 'reader': 'ffmpeg'
 
 use_faces = False
 minfacesize = 30 # for a full region (less if the tracker region is smaller)
@@ -890,16 +1326,35 @@ faces_roi = None
 face_attract_rate = 0.02
 face_anchor = np.float32([0.5, 0.75])
 
-undoqueue = []
+drag_tag = ('drag', 0) # current mouse drag, for merging its undo steps
+tracker_tag = ('tracker', 0) # same for a tracker run
+
+reportout = sys.stdout # report()'s JSON lines. dumps send everything else to stderr
 
 if __name__ == '__main__':
+	logging.basicConfig(level=logging.INFO, format='%(message)s')
+
 	do_dump = False
+	dump_jobs = 1
+	dump_graph = False
 	if sys.argv[1] == 'dump':
+		# dump [--jobs N | --ffmpeg-graph] metafile videodest
 		do_dump = True
-		videodest = sys.argv[3]
-		sys.argv.pop(3)
 		sys.argv.pop(1)
-		
+		while sys.argv[1].startswith('--'):
+			option = sys.argv.pop(1)
+			if option == '--jobs':
+				dump_jobs = int(sys.argv.pop(1))
+			elif option == '--ffmpeg-graph':
+				dump_graph = True
+			else:
+				assert False, "unknown option {0}".format(option)
+		videodest = sys.argv[2]
+		sys.argv.pop(2)
+
+		# stdout is report()'s alone, machine-readable
+		sys.stdout = sys.stderr
+
 		print sys.argv
 	
 	metafile = sys.argv[1]
@@ -931,6 +1386,12 @@ if __name__ == '__main__':
 	if 'tracker_adapt_rate' in meta:
 		tracker_adapt_rate = float(meta['tracker_adapt_rate'])
 
+	if 'tracker_warps' in meta:
+		tracker_warps = int(meta['tracker_warps'])
+
+	if 'tracker_seed' in meta:
+		tracker_seed = meta['tracker_seed']
+
 	if 'face_attract_rate' in meta:
 		face_attract_rate = float(meta['face_attract_rate'])
 
@@ -940,8 +1401,21 @@ if __name__ == '__main__':
 	if 'faces_rel_roi' in meta:
 		faces_rel_roi = np.float32(meta['faces_rel_roi'])
 
+	if 'render_subpixel' in meta:
+		render_subpixel = bool(meta['render_subpixel'])
+
+	if 'render_yuv' in meta:
+		render_yuv = bool(meta['render_yuv'])
+
+	if render_yuv and (screenw % 2 or screenh % 2):
+		print "odd screen size, rendering bgr24"
+		render_yuv = False
+
+	if 'progress_interval' in meta:
+		progress_interval = float(meta['progress_interval'])
+
 	assert os.path.exists(meta['source'])
-	srcvid = cv2.VideoCapture(meta['source'])
+	srcvid = open_video(meta['source'])
 	
 	framerate = srcvid.get(cv2.CAP_PROP_FPS)
 	totalframes = int(srcvid.get(cv2.CAP_PROP_FRAME_COUNT))
@@ -949,51 +1423,146 @@ if __name__ == '__main__':
 	srcw = int(srcvid.get(cv2.CAP_PROP_FRAME_WIDTH))
 	srch = int(srcvid.get(cv2.CAP_PROP_FRAME_HEIGHT))
 
-	emptyrow = np.uint8([(0,0,0)] * srcw)
-
+	# interactive work can run on a downscaled proxy, renders use the source.
+	# keyframes, anchors and faces stay in source coordinates.
+	videofile = meta['source']
+	if ('proxy' in meta) and not do_dump:
+		proxyconf = meta['proxy']
+		videofile = make_proxy(meta['source'], proxyconf.get('path'), float(proxyconf.get('scale', 0.5)))
+		srcvid.release()
+		srcvid = open_video(videofile)
+		if int(srcvid.get(cv2.CAP_PROP_FRAME_COUNT)) != totalframes:
+			print "warning: proxy has {0} frames, source has {1}".format(int(srcvid.get(cv2.CAP_PROP_FRAME_COUNT)), totalframes)
+
+	vidw = int(srcvid.get(cv2.CAP_PROP_FRAME_WIDTH))
+	vidh = int(srcvid.get(cv2.CAP_PROP_FRAME_HEIGHT))
+	proxyscale = vidw / srcw
+	if videofile != meta['source']:
+		print "editing on proxy {0}, {1}x{2}".format(videofile, vidw, vidh)
+
+
+	# working rate: meta 'fps' (may be fractional), or the source decimated to <= 30
 	decimate = 1
 	while framerate / decimate > 30:
 		decimate += 1
-	srcvid = RateChangedVideo(srcvid, decimate=decimate)
-	
-	framerate /= decimate
+	srcvid = RateChangedVideo(srcvid, fps=float(meta.get('fps', framerate / decimate)))
 	
-	totalframes //= decimate
-	totalframes -= (decimate > 1) # shouldn't be needed... debug?
+	framerate = srcvid.fps
+	totalframes = srcvid.framecount
 
 	print "{0} fps effective".format(framerate)
 
+	smoother = Smoother.from_meta(meta.get('smoothing'), framerate)
+
 	meta['source_fps'] = framerate
 	meta['source_framecount'] = totalframes
 	meta['source_wh'] = (srcw, srch)
 	
 	print json.dumps(meta, indent=2, sort_keys=True)
 	
-	keyframes = []
-	
-	if os.path.exists(meta['keyframes']):
-		keyframes = [
-			None if keyframe is None else np.float32(keyframe)
-			for keyframe in json.load(open(meta['keyframes']))
-		]
-	
-	if len(keyframes) < totalframes:
-		keyframes += [None] * (totalframes - len(keyframes))
+	# keyframes live in a binary snapshot + edit journal. the JSON file is
+	# imported when it's newer, and exported on exit. journal edits the
+	# import lacks (a crashed session) are kept aside as .bak files.
+	snapshotfile = meta.get('keyframes_snapshot', os.path.splitext(meta['keyframes'])[0] + '.npz')
+	jsonfile = meta['keyframes']
+	if os.path.exists(snapshotfile) and not (os.path.exists(jsonfile) and os.path.getmtime(jsonfile) > os.path.getmtime(snapshotfile)):
+		keyframes = None
+	elif os.path.exists(jsonfile):
+		print "importing keyframes from {0}".format(jsonfile)
+		keyframes = KeyframeStore.from_list(json.load(open(jsonfile)), totalframes)
+	else:
+		keyframes = KeyframeStore(totalframes)
+
+	# the JSON matches an import, after loading the snapshot it may be behind
+	exported_version = 0 if (keyframes is not None) else -1
+
+	if do_dump: # read only, a session may be running
+		journal = None
+		if keyframes is None:
+			keyframes = KeyframeJournal.load(snapshotfile, totalframes)
+	else:
+		journal = KeyframeJournal.open(snapshotfile, totalframes, store=keyframes)
+		keyframes = journal.store
+		history = EditHistory(keyframes, maxbytes=int(meta.get('undo_mb', 16) * 2**20))
+
+	# what gets rendered, kept up to date with the keyframes
+	final_trajectory = TrajectoryCache(
+		keyframes, meta['anchor'],
+		meta['anchor_x_range'], meta['anchor_y_range'],
+		sigma=meta.get('sigma', 0) * framerate)
 	
+	framebytes = vidw * vidh * 3
+
+	# decoded frames on disk, reused across sessions
+	store = None
+	if 'frame_store' in meta:
+		storeconf = meta['frame_store']
+		storescale = float(storeconf.get('scale', 1.0))
+		maxbytes = None
+		if 'max_mb' in storeconf:
+			maxbytes = int(storeconf['max_mb'] * 2**20)
+		if not (do_dump and storescale != 1): # renders need full resolution
+			store = FrameStore(
+				storeconf.get('path', videofile),
+				{ 'source': file_signature(videofile), 'fps': framerate },
+				totalframes, (vidw, vidh),
+				scale=storescale, maxbytes=maxbytes,
+				readonly=do_dump) # a render doesn't fill the disk with its frames
+
+	gops = None
+	if meta.get('gop_index', True):
+		gopindex = GOPIndex.open(videofile)
+		if gopindex:
+			gops = sorted(set(srcvid.from_source_index(k) for k in gopindex.keyframes))
+			print "GOP index: {0} key frames".format(len(gops))
+
 	if do_dump:
-		src = VideoSource(srcvid, numcache=10)
-		dump_video(videodest)
+		src = VideoSource(srcvid, totalframes, cachebytes=10 * framebytes, gops=gops, store=store)
+		dump_video(videodest, dump_jobs, dump_graph)
+		src.close()
 		sys.exit(0)
 	
+	readahead = int(meta.get('readahead', 25))
+
+	# rows around the anchor for the x-t graph, at the graph window's width
+	stripes = StripeStore(
+		totalframes,
+		width=min(vidw, iround(srcw * dispscale)),
+		radius=int(meta.get('stripe_radius', 2)),
+		maxbytes=int(meta.get('stripe_cache_mb', 256) * 2**20))
+	emptyrow = np.zeros((stripes.width, 3), dtype=np.uint8)
+
+	if 'frame_cache_mb' in meta:
+		cachebytes = int(meta['frame_cache_mb'] * 2**20)
+	else:
+		# the read-ahead window, and a GOP or two behind the playhead
+		cachebytes = (readahead+60) * framebytes
+
 	src = VideoSource(
-		srcvid,
-		numcache=graphslices+10,
-		equalize=meta.get('equalize', False))
+		srcvid, totalframes,
+		cachebytes=cachebytes,
+		readahead=readahead,
+		gops=gops,
+		store=store,
+		preprocess=[equalize_frame] if meta.get('equalize', False) else [],
+		hooks=[store_stripe])
+
+	# ffmpeg scales and converts for the tracker, saving cvtColor+resize per
+	# frame. a second decode, so it only runs while the tracker or faces do
+	if meta.get('reader', 'opencv') == 'ffmpeg':
+		graysize = (iround(vidw * trackerscale / proxyscale), iround(vidh * trackerscale / proxyscale))
+		grayvid = RateChangedVideo(
+			FFReader(videofile, size=graysize, pixfmt='gray', threads=int(meta.get('reader_threads', 0))),
+			fps=framerate)
+		graysrc = CachingVideoReader(
+			grayvid, totalframes,
+			cachebytes=(readahead+60) * graysize[0] * graysize[1],
+			readahead=readahead,
+			gops=gops,
+			preprocess=[cv2.equalizeHist] if meta.get('equalize', False) else [])
 	
-	if not all(k is None for k in keyframes):
-		lastkey = scan_nonempty(keyframes, len(keyframes)-1, -totalframes)
-		#lastkey = max(k for k in xrange(totalframes) if keyframes[k] is not None)
-		load_this_frame(lastkey)
+	if keyframes.keys:
+		load_this_frame(keyframes.prev_key(totalframes-1))
 	else:
 		load_this_frame(0)
 
@@ -1027,6 +1596,11 @@ if __name__ == '__main__':
 				redraw_display()
 
 			key = cv2.waitKey(1)
+
+			# read-ahead follows the playback direction, pauses when stopped
+			src.set_direction(sgn(playspeed) if abs(playspeed) > 1e-3 else 0)
+			if graysrc is not None:
+				graysrc.set_direction(src.direction if (use_tracker or use_faces) else 0)
 			
 			if abs(playspeed) > 1e-3:
 				now = time.clock()
@@ -1039,7 +1613,7 @@ if __name__ == '__main__':
 				do_stop = load_delta_frame(sgn(playspeed))
 
 				if mousedown:
-					keyframes[src.index] = anchor
+					set_keyframe(src.index, anchor, drag_tag)
 				else:
 					anchor = get_keyframe(src.index)
 
@@ -1065,7 +1639,7 @@ if __name__ == '__main__':
 				if key == VK_PGUP: delta = 25
 				
 				if mousedown:
-					keyframes[src.index] = anchor
+					set_keyframe(src.index, anchor, drag_tag)
 				else:
 					anchor = get_keyframe(src.index)
 
@@ -1075,10 +1649,10 @@ if __name__ == '__main__':
 				delta = 1
 				if key == VK_PGDN:
 					delta = 25
-					src.cache_range(src.index, src.index+delta+1)
+					src.get_range(src.index, src.index+delta+1)
 				
 				if mousedown:
-					keyframes[src.index] = anchor
+					set_keyframe(src.index, anchor, drag_tag)
 				else:
 					anchor = get_keyframe(src.index)
 			
@@ -1086,26 +1660,18 @@ if __name__ == '__main__':
 
 			if key == ord('x'):
 				if keyframes[src.index] is not None:
-					def undo(index):
-						point = keyframes[src.index]
-						def sub():
-							print "restoring keyframe {0} (was {1})".format(index, keyframes[index] if index in keyframes else None)
-							keyframes[index] = point
-							print "keyframe restored to {1}".format(point)
-						return sub
-					undoqueue.append(undo(src.index))
-
-					keyframes[src.index] = None
+					with history.change(src.index, src.index+1, "delete keyframe {0}".format(src.index)):
+						keyframes[src.index] = None
 					anchor = get_keyframe(src.index)
 					redraw = True
 
 					print "keyframe {0} deleted".format(src.index)
 			
-			if key == ord('c'): # cache all frames in the graph
+			if key == ord('c'): # cache all rows in the graph
 				draw_graph = True
 				imax = graphbg_head
 				imin = imax - graphslices
-				src.cache_range(imin, imax)
+				cache_stripes(imin, imax, background=True)
 				redraw = True
 				graphbg = None
 				print "graph cached."
@@ -1137,20 +1703,22 @@ if __name__ == '__main__':
 			if key == ord('s'):
 				save()
 				print "saved"
+
+			if key == ord('i'):
+				print "frame cache: {frames} frames ({pinned} pinned), {mbytes:.0f} MB, {hits} hits, {misses} misses, {evictions} evictions; {decoded} decoded, {restored} from store, {seeks} seeks".format(**src.stats())
 			
 			if key == ord('d'):
 				graphdraw = not graphdraw
 				print "manual drawing in graph:", graphdraw
 
-			if key == 26: # ctrl-z
-				if undoqueue:
-					print "undoing..."
-					item = undoqueue.pop()
-					item()
-					print "undone"
-					redraw = True
+			if key in (26, 25): # ctrl-z, ctrl-y
+				label = history.undo() if (key == 26) else history.redo()
+				if label is None:
+					print "nothing to be {0}".format("undone" if (key == 26) else "redone")
 				else:
-					print "nothing to be undone"
+					print "{0}: {1}".format("undone" if (key == 26) else "redone", label)
+					anchor = get_keyframe(src.index)
+					redraw = True
 			
 			if key == ord('l'):
 				playspeed += 0.5
@@ -1204,8 +1772,12 @@ if __name__ == '__main__':
 	# switchable
 
 	finally:
+		src.close()
+		if graysrc is not None:
+			graysrc.close()
 		cv2.destroyWindow('tracker state')
 		cv2.destroyWindow("source")
 		cv2.destroyWindow("output")
 		cv2.destroyWindow("graph")
 		save(do_query=True)
+		journal.close()
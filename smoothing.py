@@ -0,0 +1,102 @@
+from __future__ import division
+import numpy as np
+import scipy.ndimage
+import scipy.signal
+
+class Smoother(object):
+	"""smooths (N,2) anchor trajectories, a whole array at a time.
+
+	methods and their parameters (in frames, or Hz for one-euro):
+	  box       radius (2): mean over 2*radius+1 frames
+	  gaussian  sigma (2.0)
+	  savgol    window (11, odd), order (2): Savitzky-Golay
+	  one-euro  mincutoff (1.0), beta (0.01), dcutoff (1.0): adaptive
+	            low-pass, run forwards and backwards so it doesn't lag
+
+	'support' is how many frames of context each side a smoothed range
+	needs, smooth_range() fetches them.
+	"""
+
+	def __init__(self, method='box', rate=25.0, **params):
+		self.method = method
+		self.rate = rate
+		self.params = params
+
+		if method == 'box':
+			self.support = int(params.get('radius', 2))
+		elif method == 'gaussian':
+			self.support = int(np.ceil(4 * float(params.get('sigma', 2.0))))
+		elif method == 'savgol':
+			self.support = int(params.get('window', 11)) // 2
+		elif method == 'one-euro':
+			# the filter's memory: a few time constants at the lowest cutoff
+			tau = 1 / (2 * np.pi * float(params.get('mincutoff', 1.0)))
+			self.support = int(np.ceil(3 * tau * rate))
+		else:
+			raise ValueError("unknown smoothing method {0!r}".format(method))
+
+	@classmethod
+	def from_meta(cls, conf, rate):
+		"conf: meta['smoothing'], e.g. {\"method\": \"gaussian\", \"sigma\": 3}"
+		conf = dict(conf or {})
+		return cls(conf.pop('method', 'box'), rate=rate, **conf)
+
+	def smooth(self, values):
+		"smoothed copy of values, edges are held"
+		values = np.asarray(values, dtype=np.float64)
+		if len(values) == 0:
+			return values.astype(np.float32)
+
+		if self.method == 'box':
+			r = self.support
+			padded = np.pad(values, ((r, r), (0, 0)), mode='edge')
+			sums = np.concatenate([np.zeros((1, 2)), np.cumsum(padded, axis=0)])
+			result = (sums[2*r+1:] - sums[:-2*r-1]) / (2*r+1)
+
+		elif self.method == 'gaussian':
+			result = scipy.ndimage.gaussian_filter1d(values, float(self.params.get('sigma', 2.0)), axis=0, mode='nearest')
+
+		elif self.method == 'savgol':
+			window = int(self.params.get('window', 11)) | 1
+			order = int(self.params.get('order', 2))
+			if len(values) < window:
+				return values.astype(np.float32)
+			result = scipy.signal.savgol_filter(values, window, order, axis=0, mode='nearest')
+
+		elif self.method == 'one-euro':
+			forward = self._one_euro(values)
+			backward = self._one_euro(values[::-1])[::-1]
+			result = (forward + backward) / 2
+
+		return result.astype(np.float32)
+
+	def smooth_range(self, trajectory, start, stop):
+		"smoothed positions of frames [start, stop), trajectory(start, stop) gives the input"
+		s = self.support
+		return self.smooth(trajectory(start - s, stop + s))[s : s + (stop - start)]
+
+	def _one_euro(self, values):
+		# Casiez et al., 2012. per sample recursion, on plain floats
+		mincutoff = float(self.params.get('mincutoff', 1.0))
+		beta = float(self.params.get('beta', 0.01))
+		dcutoff = float(self.params.get('dcutoff', 1.0))
+		te = 1 / self.rate
+
+		def alpha(cutoff):
+			r = 2 * np.pi * cutoff * te
+			return r / (r + 1)
+
+		ad = alpha(dcutoff)
+		result = np.empty_like(values)
+		for col in xrange(values.shape[1]):
+			xs = values[:,col].tolist()
+			out = [0.0] * len(xs)
+			x = out[0] = xs[0]
+			dx = 0.0
+			for i in xrange(1, len(xs)):
+				dx += ad * ((xs[i] - xs[i-1]) / te - dx)
+				a = alpha(mincutoff + beta * abs(dx))
+				x += a * (xs[i] - x)
+				out[i] = x
+			result[:,col] = out
+		return result
@@ -0,0 +1,126 @@
+from __future__ import division
+import numpy as np
+import scipy.ndimage
+
+# an unset frame takes its position from keyframes at most this far away
+hold = 100
+
+def interpolate(keys, values, start, stop, count, default, hold=hold):
+	"""anchor positions of frames [start, stop), in one vectorised pass.
+
+	keys: sorted indices of the set keyframes, values: their (x,y).
+	a set frame is its keyframe. an unset frame is interpolated between the
+	nearest keyframes within 'hold' frames on either side, or held at the
+	one it has, else 'default'. so are frames outside [0, count).
+
+	interpolated values carry the +0.5 of the original per-frame lookup,
+	in the same float32 arithmetic.
+	"""
+	keys = np.asarray(keys, dtype=np.int64)
+	values = np.asarray(values, dtype=np.float32).reshape(-1, 2)
+
+	indices = np.arange(start, stop)
+	output = np.empty((len(indices), 2), dtype=np.float32)
+	output[:] = np.float32(default)
+
+	if len(keys) == 0:
+		return output
+
+	inside = (indices >= 0) & (indices < count)
+
+	# next keyframe at or after each index, and the one before that
+	n = np.searchsorted(keys, indices, side='left')
+	p = n - 1
+	nc = np.minimum(n, len(keys) - 1)
+	pc = np.maximum(p, 0)
+
+	isset = inside & (n < len(keys)) & (keys[nc] == indices)
+
+	# neighbours for unset frames: the keyframe at n is after the index
+	hasprev = inside & ~isset & (p >= 0) & (indices - keys[pc] <= hold)
+	hasnext = inside & ~isset & (n < len(keys)) & (keys[nc] - indices <= hold)
+
+	output[isset] = values[nc[isset]]
+
+	only = hasprev & ~hasnext
+	output[only] = values[pc[only]]
+	only = hasnext & ~hasprev
+	output[only] = values[nc[only]]
+
+	both = hasprev & hasnext
+	u = values[pc[both]]
+	v = values[nc[both]]
+	alpha = ((indices[both] - keys[pc[both]]) / (keys[nc[both]] - keys[pc[both]])).astype(np.float32)
+	output[both] = (np.float32(0.5) + u) + alpha[:,np.newaxis] * (v - u)
+
+	return output
+
+
+class TrajectoryCache(object):
+	"""the final anchor trajectory, as rendered: interpolated, clipped to the
+	anchor ranges and gaussian smoothed (sigma in frames).
+
+	materialised once. keyframe changes (store listeners) mark a window
+	dirty, the change plus what interpolation and the filter can carry it,
+	and only dirty windows are recomputed, when read. the results equal a
+	computation over the whole video.
+	"""
+
+	def __init__(self, store, default, xrange, yrange, sigma=0, hold=hold):
+		self.store = store
+		self.count = store.count
+		self.default = default
+		self.lower = np.float32([xrange[0], yrange[0]])
+		self.upper = np.float32([xrange[1], yrange[1]])
+		self.sigma = sigma
+		self.hold = hold
+		# scipy's kernel radius at the default truncate=4
+		self.radius = int(4 * sigma + 0.5) if sigma > 0 else 0
+
+		self.values = np.empty((self.count, 2), dtype=np.float32)
+		self.dirty = [(0, self.count)] # sorted, disjoint
+		store.listeners.append(self.invalidate)
+
+	def invalidate(self, start, stop):
+		reach = self.hold + self.radius + 1
+		(start, stop) = (max(0, start - reach), min(self.count, stop + reach))
+
+		# merge with overlapping or touching windows
+		merged = []
+		for (a, b) in self.dirty:
+			if b < start or a > stop:
+				merged.append((a, b))
+			else:
+				(start, stop) = (min(a, start), max(b, stop))
+		merged.append((start, stop))
+		self.dirty = sorted(merged)
+
+	def get(self, start=0, stop=None):
+		"final positions of frames [start, stop), clipped to the video"
+		if stop is None:
+			stop = self.count
+		(start, stop) = (max(0, start), min(self.count, stop))
+
+		pending = []
+		for (a, b) in self.dirty:
+			if a < stop and b > start:
+				self._compute(a, b)
+			else:
+				pending.append((a, b))
+		self.dirty = pending
+
+		return self.values[start:stop].copy()
+
+	def _compute(self, start, stop):
+		# the filter needs its radius of context, the interpolation its hold
+		(c0, c1) = (max(0, start - self.radius), min(self.count, stop + self.radius))
+		(keys, values) = self.store.keys_in(c0 - self.hold, c1 + self.hold)
+		output = interpolate(keys, values, c0, c1, self.count, self.default, self.hold)
+
+		np.clip(output, self.lower, self.upper, out=output)
+
+		if self.sigma > 0:
+			# mode as scipy.ndimage.gaussian_filter's, it only matters at the video's ends
+			output = scipy.ndimage.gaussian_filter1d(output, self.sigma, axis=0, mode='reflect')
+
+		self.values[start:stop] = output[start-c0 : stop-c0]